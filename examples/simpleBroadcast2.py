@@ -35,7 +35,6 @@ To stop the server send '/KTHXBYE' as a string
 
 
 import sys
-import warnings
 
 sys.path.insert(0, '..')
 import serpy2 as sp
@@ -46,22 +45,20 @@ PORT = 8000
 NB_CONN = 100
 
 def main(args):
-    s = sp.Server(ADR, PORT, NB_CONN).start()
+    # one Reactor thread serves all NB_CONN connections
+    s = sp.Server(ADR, PORT, NB_CONN, engine='selector').start()
     print("Server started")
     stop_flag = False
     while not stop_flag:
         read_conn_list = s.readableConnections()
-        conn_list = s.getConnectionsList()
         for rc in read_conn_list:
             data = rc.getData()
             print(data)
             if data == '/KTHXBYE':
                 stop_flag = True
                 break
-            for c in conn_list:
-                if c != rc:
-                    with warnings.catch_warnings():
-                        c.sendData(data)
+            # encoded once, sent to all the other connections
+            s.broadcast(data, exclude=rc, policy='drop')
         if not read_conn_list: sleep(0.01) # allow this thread to rest
     s.closeServer()
     print("Server closed")
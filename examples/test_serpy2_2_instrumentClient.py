@@ -10,8 +10,7 @@ This test client sends various types of data to the server, and checks if it
 receives the expected response back.
 
 In this case, not all data sent will lead to a response, only when sending an
-integer, a blob of bytes will be received in return, which can be converted 
-into a 2D numpy array representing an image.
+integer, a 2D numpy array representing an image will be received in return.
 
 More precisely, the 2D array is a float32 image, whose dimensions
 are set inside `test_serpy2_2_utils.py`; later we may extend the simple
@@ -33,7 +32,7 @@ import numpy as np
 
 import serpy2 as sp
 
-from test_serpy2_2_utils import float32_numpy_image, bytes_to_float32img
+from test_serpy2_2_utils import float32_numpy_image
 
 
 ADR = 'localhost'
@@ -71,14 +70,14 @@ for i in range(10):
         except sp.queue.Empty:
             print('*** TIMEOUT ERROR ***')
             Nerr += 1
-        if type(t) is not bytes:
+        if type(t) is not np.ndarray:
             print('*** DATA RECEPTION ERROR ***')
             Nerr += 1  
         else:
-            print('recv.... <',len(t),'bytes>')
-            bytesrcvd += len(t)
+            print('recv.... <',t.nbytes,'bytes>')
+            bytesrcvd += t.nbytes
             print('p data: ', expect, end=' : ')
-            gotimg32 = bytes_to_float32img(t) # decode the received image
+            gotimg32 = t # the received image, with its dtype and shape
             expimg32 = float32_numpy_image(expect) # generate the expected image
             if np.array_equal(gotimg32, expimg32):
                 print('DATA OK')
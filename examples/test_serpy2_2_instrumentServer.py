@@ -12,7 +12,8 @@ parameter setting).
 
 At present, the accepted 'requests' are extremely simple. If an integer value
 is received by the server, it will generate image-like data (2D array) in a
-numpy array and send it to the client in a binary blob.
+numpy array and send it to the client. serpy2 sends the array with its dtype
+and shape, directly from the memory of the array.
 
 More precisely, the 2D array is a float32 image, whose dimensions
 are set inside `test_serpy2_2_utils.py`; later we may extend the simple
@@ -32,7 +33,7 @@ sys.path.insert(0, '..')
 import serpy2 as sp
 from time import sleep
 
-from test_serpy2_2_utils import float32_numpy_image, float32_to_bytes
+from test_serpy2_2_utils import float32_numpy_image
 
 
 ADR = ''
@@ -61,10 +62,9 @@ while not stop_flag:
             break
         elif type(data) == int:
             # make image based on value of 'data'
-            # and send it encoded as bytes
+            # and send it (as a numpy array)
             img32 = float32_numpy_image(data)
-            bb = float32_to_bytes(img32)
-            rc.sendData(bb)
+            rc.sendData(img32)
         else:
             print('--> data ignored')
     if len(read_conn_list)==0:
@@ -10,6 +10,9 @@ Utility functions used by both the client and the server in this
 `test_serpy2_2` test.
 
 Generate float32 image and convert to/from blobs of bytes.
+
+serpy2 can send numpy arrays directly (with dtype and shape), so the
+conversion functions are no longer needed by the test scripts.
 """
 
 import numpy as np
@@ -28,11 +28,87 @@ import queue
 import select
 #from weakref import finalize
 from base64 import b85encode, b85decode
-from time import sleep
+from time import sleep, monotonic
 import pickle
 import warnings
 
-STIMEOUT = 0.050
+STIMEOUT = 0.050 # The worker threads do not poll anymore: they block until
+                 # there is work or until the Connection is closed. This
+                 # delay (in seconds) is no longer used internally.
+
+class BlockQueue(queue.Queue):
+    """
+    A queue.Queue whose blocked producers and/or consumers can all be
+    released at once with stop(), e.g. when a Connection is closed.
+    
+    Threads waiting on a BlockQueue therefore do not need to poll a stop
+    flag: they block until there is work, or until the queue is stopped.
+    Once stopped, a put that would block raises queue.Full and a get that
+    would block raises queue.Empty, until restart() is called.
+    """
+    def __init__(self, maxsize=0):
+        super().__init__(maxsize)
+        self.put_stopped = False
+        self.get_stopped = False
+
+    def stop(self, put=True, get=True):
+        """Release the blocked producers (put) and/or consumers (get)."""
+        with self.mutex:
+            self.put_stopped = self.put_stopped or put
+            self.get_stopped = self.get_stopped or get
+            self.not_full.notify_all()
+            self.not_empty.notify_all()
+
+    def restart(self):
+        """Have put and get block again."""
+        with self.mutex:
+            self.put_stopped = False
+            self.get_stopped = False
+
+    def put(self, item, block=True, timeout=None):
+        with self.not_full:
+            if self.maxsize > 0:
+                endtime = None
+                if timeout is not None:
+                    if timeout < 0:
+                        raise ValueError("'timeout' must be a non-negative number")
+                    endtime = monotonic() + timeout
+                while self._qsize() >= self.maxsize:
+                    if not block or self.put_stopped:
+                        raise queue.Full
+                    if endtime is None:
+                        self.not_full.wait()
+                    else:
+                        remaining = endtime - monotonic()
+                        if remaining <= 0.0:
+                            raise queue.Full
+                        self.not_full.wait(remaining)
+            self._put(item)
+            self.unfinished_tasks += 1
+            self.not_empty.notify()
+
+    def get(self, block=True, timeout=None):
+        with self.not_empty:
+            endtime = None
+            if timeout is not None:
+                if timeout < 0:
+                    raise ValueError("'timeout' must be a non-negative number")
+                endtime = monotonic() + timeout
+            while not self._qsize():
+                if not block or self.get_stopped:
+                    raise queue.Empty
+                if endtime is None:
+                    self.not_empty.wait()
+                else:
+                    remaining = endtime - monotonic()
+                    if remaining <= 0.0:
+                        raise queue.Empty
+                    self.not_empty.wait(remaining)
+            item = self._get()
+            self.not_full.notify()
+            return item
+
+
 
 class Connection:
     """
@@ -56,10 +132,10 @@ class Connection:
         self.auto_restart = auto_restart
         self.allow_unpickle = allow_unpickle
         self.connected = sock != None
-        self.in_q = queue.Queue(10)
-        self.out_q = queue.Queue(10)
-        self.block_q = queue.Queue(10)
-        self.out_block_q = queue.Queue(10)
+        self.in_q = BlockQueue(10)
+        self.out_q = BlockQueue(10)
+        self.block_q = BlockQueue(10)
+        self.out_block_q = BlockQueue(10)
         self.stop_sig = False
         self.in_mode = 0
         self.out_mode = 0
@@ -100,6 +176,8 @@ class Connection:
     def start(self):
         """Start the connection (start the threads)"""
         self.stop_sig = False
+        for q in (self.in_q, self.out_q, self.block_q, self.out_block_q):
+            q.restart()
         threadSet = set()
         threadSet.add(threading.Thread(target=self._inThread))
         threadSet.add(threading.Thread(target=self._outThread))
@@ -114,7 +192,17 @@ class Connection:
         self.stop_sig = True
         self.ackEvent.set() #setting events to free the threads
         self.modeChangeEvent.set()
+        # release the threads blocked on the queues and on the socket
+        for q in (self.out_q, self.block_q, self.out_block_q):
+            q.stop()
+        self.in_q.stop(get=False)
+        try:
+            self.conn.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass # already disconnected
         for t in self.threadSet:
+            if t is threading.current_thread():
+                continue
             t.join()
         self.conn.close()
         self.connected = False
@@ -157,12 +245,16 @@ class Connection:
         Get blocks when available and sends them
         """
         while not self.stop_sig:
-            readable, writable, errored = select.select([], (self.conn,), [], STIMEOUT)
-            for s in writable:
-                if not self.out_block_q.empty():
-                    s.sendall(self.out_block_q.get()+b'\x1F')
-                else :
-                    sleep(STIMEOUT)
+            try:
+                block = self.out_block_q.get() # blocks until there is work
+            except queue.Empty:
+                break # out_block_q stopped: Connection closed
+            try:
+                self.conn.sendall(block+b'\x1F')
+            except OSError:
+                if not self.stop_sig:
+                    self._brokenConnection()
+                break
         exit()
                 
     def _inThread(self):
@@ -176,28 +268,26 @@ class Connection:
         """
         data = bytes()
         while not self.stop_sig:
-            readable, writable, errored = select.select((self.conn,), [], (self.conn,), STIMEOUT)
-            if errored :
-                self._brokenConnection()
-                continue
-            
-            for s in readable:
-                if not self.block_q.full():
-                    try:
-                        chunk = self.conn.recv(4096)
-                    except ConnectionResetError:
-                        self._brokenConnection()
-                    else:
-                        if chunk:
-                            data += chunk
-                        else :
-                            self._brokenConnection()
+            # Blocking recv: returns as soon as data arrives, or when the
+            # socket is shut down by close()
+            try:
+                chunk = self.conn.recv(4096)
+            except OSError:
+                chunk = bytes()
+            if not chunk:
+                if not self.stop_sig:
+                    self._brokenConnection()
+                break
+            data += chunk
 
             if b'\x1F' in data:
                 *blocks, data = data.split(b'\x1F')
-                for block in blocks:
-                    if block :
-                        self.block_q.put(block)
+                try:
+                    for block in blocks:
+                        if block :
+                            self.block_q.put(block)
+                except queue.Full:
+                    break # block_q stopped: Connection closed
         exit()
         
     def _listeningCenterThread(self):
@@ -208,7 +298,8 @@ class Connection:
         """
         data = bytes()
         while not self.stop_sig:
-            if not self.block_q.empty():
+            try:
+                # blocks until there is work
                 block = self.block_q.get()
                 if block.startswith(b'\x01'): # indicates internal communication
                     block = block.decode(self.encoding)[1:]
@@ -260,8 +351,8 @@ class Connection:
                             self.in_q.put(pickle.loads(b85decode(message)))
                         else:
                             self.in_q.put(b85decode(message))
-            else:
-                sleep(STIMEOUT)
+            except (queue.Empty, queue.Full):
+                break # queues stopped: Connection closed
         exit()
                     
             
@@ -271,7 +362,8 @@ class Connection:
         implements the internal communication protocol.
         """
         while not self.stop_sig:
-            if not self.out_q.empty():
+            try:
+                # blocks until there is work
                 block, mode = self.out_q.get()
                 if mode != self.out_mode :
                     self.modeChangeEvent.clear()
@@ -285,8 +377,8 @@ class Connection:
                 # blocking
                 elif mode == 1 or mode == 3 or mode == 5:
                     self.out_block_q.put(block+b'\x04')
-            else:
-                sleep(STIMEOUT)
+            except (queue.Empty, queue.Full):
+                break # queues stopped: Connection closed
         exit()
                 
     
@@ -424,17 +516,22 @@ class Server:
 
     def _serverThread(self):
         while not self.stop_sig:
-            readable, writable, errored = select.select((self.serv,), [], [], STIMEOUT)
+            # Blocks until a client connects, or until close() wakes it up
+            readable, writable, errored = select.select((self.serv, self._wake_r), [], [])
+            if self.stop_sig:
+                break
             for s in readable :
+                if s is self._wake_r:
+                    continue
                 conn, adr = s.accept()
                 #warnings.warn("Connection to ", adr, " accepted")
                 c = Connection(sock=conn, encoding=self.encoding, allow_unpickle=self.allow_unpickle)
                 c.start()
-                self.connections.append(c)
                 self.newConn.put(c)
-            for c in self.connections: #clear disconected connections
-                if not c.connected:
-                    self.connections.remove(c)
+                with self.lock: #clear disconected connections
+                    self.connections = [cc for cc in self.connections
+                                        if cc.connected]
+                    self.connections.append(c)
         exit()
     
     def __iter__(self):
@@ -454,6 +551,7 @@ class Server:
         """
         Start the server thread. Returns self (ie: the Server object)
         """
+        self._wake_r, self._wake_w = socket.socketpair()
         self.tSer = threading.Thread(target=self._serverThread)
         self.tSer.start()
         return self
@@ -464,7 +562,10 @@ class Server:
         One can still get the connection list afterward.
         """
         self.stop_sig = True
+        self._wake_w.send(b'\x00')
         self.tSer.join()
+        self._wake_r.close()
+        self._wake_w.close()
         for c in self.connections :
             c.close()
         self.serv.close()
@@ -2,3 +2,4 @@
 # -*- coding: utf-8 -*-
 
 from .serpy2 import *
+from .aio import AsyncConnection, AsyncServer
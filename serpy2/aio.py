@@ -0,0 +1,409 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  aio.py
+#
+#      asyncio interface to the serpy2 protocol
+#
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+#
+#  The AsyncConnection and AsyncServer objects speak exactly the same
+#  protocol as serpy2.Connection and serpy2.Server, and can be used as
+#  their peers. They run on an asyncio event loop and do not use any
+#  thread.
+
+
+import asyncio
+import warnings
+
+from .serpy2 import QUEUELEN, CHUNKSIZE, NBCHANNELS, BlockParser, \
+                    _checkChecksumName, _checkChunkSize, _encodeData, \
+                    _decodeData, _encodeFrames, _payloadParts, _RPCMessage
+
+
+_EOF = object() # put in the input queue when the connection is lost
+
+
+
+class AsyncConnection(asyncio.BufferedProtocol):
+    """
+    A serpy2 connection running on an asyncio event loop.
+
+    Incoming data is received straight into the buffers of a BlockParser,
+    decoded, and queued until it is read with recv (or async for). Each
+    logical channel (see serpy2.Connection.sendData) has its own input
+    queue: recv(channel=n) reads the data received on channel n, and
+    async for reads the default channel 0. Reading from the socket is
+    paused while the queue of any channel is full. RPC messages are not
+    supported and are dropped (with a warning).
+
+    ------
+    Usage:
+     - To create an AsyncConnection and connect it:
+        >>> c = await AsyncConnection().connect(adr, port)
+        >>> await c.send(data)
+        >>> data = await c.recv()
+        >>> data = await c.recv(channel=3)
+        >>> async for data in c:
+        ...     print(data)
+        >>> c.close()
+
+    The checksum argument selects the checksum algorithm of the blocks
+    sent, the optional pool (a BufferPool) the buffers receiving raw
+    data and ndarrays, chunksize the size of the frames of large data, and
+    compact the encoding of int and float, as for serpy2.Connection.
+    """
+    def __init__(self, checksum='sum', queuelen=QUEUELEN, server=None,
+                 pool=None, chunksize=CHUNKSIZE, compact=False):
+        _checkChecksumName(checksum)
+        _checkChunkSize(chunksize)
+        self.checksum = checksum
+        self.pool = pool
+        self.chunksize = chunksize
+        self.compact = compact
+        self.transport = None
+        self.server = server
+        self.connected = False
+        self.queuelen = queuelen
+        self.in_q = asyncio.Queue(queuelen) # channel 0
+        self.channel_qs = {} # in_q of the other channels, by channel id
+        self._parser = BlockParser(pool=pool)
+        self._rx_backlog = {} # data waiting for room, by channel id
+        self._rx_paused = False
+        self._write_paused = False
+        self._drain_waiters = []
+        self._closed = asyncio.Event()
+        self.adr = None
+
+    async def connect(self, adr, port):
+        """
+        Connect this AsyncConnection to a remote serpy2 Server (or
+        AsyncServer) at adr (address) and port. Returns self.
+        """
+        self.adr = (adr, port)
+        loop = asyncio.get_running_loop()
+        await loop.create_connection(lambda: self, adr, port)
+        return self
+
+    def close(self):
+        """Close the connection (socket)"""
+        if self.transport is not None:
+            self.transport.close()
+
+    async def waitClosed(self):
+        """Wait until the connection is closed."""
+        if self.connected:
+            await self._closed.wait()
+
+    # --- asyncio.BufferedProtocol callbacks ---
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.connected = True
+        if self.server is not None:
+            self.server._connectionMade(self)
+
+    def connection_lost(self, exc):
+        self.connected = False
+        self._closed.set()
+        if self.server is not None:
+            self.server._connectionLost(self)
+        # wake up the readers waiting on an empty in_q, on every channel
+        self._deliver(_EOF, 0)
+        for channel in self.channel_qs:
+            self._deliver(_EOF, channel)
+        # and the writers waiting for the transport to drain
+        self._resumeWriters(exc)
+
+    def get_buffer(self, sizehint):
+        return self._parser.getBuffer()
+
+    def buffer_updated(self, nbytes):
+        for btype, bdata, channel in self._parser.bufferUpdated(nbytes):
+            try:
+                data = _decodeData(btype, bdata)
+            except (TypeError, ValueError) as err:
+                print('WARNING: {}'.format(err))
+                continue
+            except Exception as err:
+                # an unexpected failure only drops this block
+                print('WARNING: Cannot decode received data ({!r})'.format(
+                      err))
+                continue
+            if type(data) is _RPCMessage:
+                print('WARNING: RPC message dropped: not supported by '
+                      'AsyncConnection')
+                continue
+            self._deliver(data, channel)
+
+    def eof_received(self):
+        return False # close the transport
+
+    def pause_writing(self):
+        self._write_paused = True
+
+    def resume_writing(self):
+        self._write_paused = False
+        self._resumeWriters(None)
+
+    # --- flow control ---
+
+    def _inQueue(self, channel):
+        """The in_q of the channel channel."""
+        if not channel:
+            return self.in_q
+        q = self.channel_qs.get(channel)
+        if q is None:
+            q = self.channel_qs[channel] = asyncio.Queue(self.queuelen)
+            if self._closed.is_set():
+                q.put_nowait(_EOF)
+        return q
+
+    def _deliver(self, data, channel):
+        """
+        Queue decoded data in the in_q of its channel. When this in_q is
+        full, reading from the socket is paused until recv makes room.
+        """
+        backlog = self._rx_backlog.get(channel)
+        if not backlog:
+            try:
+                self._inQueue(channel).put_nowait(data)
+                return
+            except asyncio.QueueFull:
+                pass
+        self._rx_backlog.setdefault(channel, []).append(data)
+        if not self._rx_paused and self.connected:
+            self._rx_paused = True
+            self.transport.pause_reading()
+
+    def _resumeReading(self, channel):
+        backlog = self._rx_backlog.get(channel)
+        q = self._inQueue(channel)
+        while backlog and not q.full():
+            q.put_nowait(backlog.pop(0))
+        if backlog is not None and not backlog:
+            del self._rx_backlog[channel]
+        if self._rx_paused and not self._rx_backlog:
+            self._rx_paused = False
+            if self.connected:
+                self.transport.resume_reading()
+
+    def _resumeWriters(self, exc):
+        waiters, self._drain_waiters = self._drain_waiters, []
+        for w in waiters:
+            if not w.done():
+                if exc is None:
+                    w.set_result(None)
+                else:
+                    w.set_exception(exc)
+
+    async def _drain(self):
+        """Wait until the transport accepts more data."""
+        if not self.connected:
+            raise ConnectionError("Connection closed")
+        if self._write_paused:
+            w = asyncio.get_running_loop().create_future()
+            self._drain_waiters.append(w)
+            await w
+
+    # --- public API ---
+
+    async def send(self, data, channel=0):
+        """
+        Send the data over this connection, on the logical channel 
+        channel (0 to 255, see serpy2.Connection.sendData). Supports the 
+        same data types as serpy2.Connection.sendData. Waits while the 
+        transport buffer is full. Raises ConnectionError if the connection
+        is closed.
+        """
+        if not 0 <= channel < NBCHANNELS:
+            raise ValueError("channel must be in 0..{}".format(NBCHANNELS-1))
+        bdata, btype = _encodeData(data, self.compact)
+        if not self.connected:
+            raise ConnectionError("Connection closed")
+        for bhead, fdata in _encodeFrames(bdata, btype, self.checksum,
+                                          self.chunksize, 0, channel):
+            self.transport.write(bhead)
+            for part in _payloadParts(fdata):
+                if len(part):
+                    self.transport.write(part)
+        await self._drain()
+
+    async def recv(self, timeout=None, channel=0):
+        """
+        Returns the data received on channel (default 0, see send) in the
+        original data type.
+
+        Waits until there is data, or until the optional timeout (in
+        seconds) is reached, which raises asyncio.TimeoutError.
+        Raises ConnectionError when the connection is closed and all the
+        data received on this channel has been read.
+        """
+        q = self._inQueue(channel)
+        if timeout is None:
+            data = await q.get()
+        else:
+            data = await asyncio.wait_for(q.get(), timeout)
+        if data is _EOF:
+            # leave the marker for the other readers
+            q.put_nowait(_EOF)
+            raise ConnectionError("Connection closed")
+        if self._rx_paused or self._rx_backlog:
+            self._resumeReading(channel)
+        return data
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        """Yields the received data until the connection is closed."""
+        try:
+            return await self.recv()
+        except ConnectionError:
+            raise StopAsyncIteration
+
+    def isConnected(self):
+        """Returns True if connected."""
+        return self.connected
+
+    def isDataAvailable(self, channel=0):
+        """
+        Return True if there is new data available
+        (ie: in the input queue of the channel)
+        """
+        q = self._inQueue(channel)
+        return not q.empty() and q._queue[0] is not _EOF
+
+
+
+
+class AsyncServer:
+    """
+    A serpy2 server running on an asyncio event loop, accepting
+    connections as AsyncConnection objects.
+
+    The new connections are delivered by the asynchronous iterator of the
+    server. The server accepts at most nb_conn (default 5) concurrent
+    connections; further connections are refused.
+
+    The checksum, queuelen, pool, chunksize and compact arguments are
+    those of the accepted AsyncConnections (see AsyncConnection).
+
+    Usage :
+     - To create a server and handle its connections:
+        >>> s = await AsyncServer(adr, port, nb_conn).start()
+        >>> async for c in s:
+        ...     asyncio.create_task(handle(c))
+        >>> await s.closeServer()
+    """
+    def __init__(self, adr, port, nb_conn=5, checksum='sum',
+                 queuelen=QUEUELEN, pool=None, chunksize=CHUNKSIZE,
+                 compact=False):
+        _checkChecksumName(checksum)
+        _checkChunkSize(chunksize)
+        self.adr = adr
+        self.port = port
+        self.nb_conn = nb_conn
+        self.checksum = checksum
+        self.queuelen = queuelen
+        self.pool = pool
+        self.chunksize = chunksize
+        self.compact = compact
+        self.connections = []
+        self.newConn = asyncio.Queue()
+        self.server = None
+
+    async def start(self):
+        """Start listening. Returns self (ie: the AsyncServer object)"""
+        loop = asyncio.get_running_loop()
+        self.server = await loop.create_server(
+            self._newConnection, self.adr, self.port, backlog=self.nb_conn,
+            reuse_address=True)
+        return self
+
+    def _newConnection(self):
+        """Make an AsyncConnection for an accepted connection."""
+        return AsyncConnection(checksum=self.checksum,
+                               queuelen=self.queuelen, server=self,
+                               pool=self.pool, chunksize=self.chunksize,
+                               compact=self.compact)
+
+    def _connectionMade(self, c):
+        if len(self.connections) >= self.nb_conn:
+            warnings.warn("Too many connections on this AsyncServer! "
+                          "Refusing connection.")
+            c.server = None
+            c.close()
+            return
+        self.connections.append(c)
+        self.newConn.put_nowait(c)
+
+    def _connectionLost(self, c):
+        if c in self.connections:
+            self.connections.remove(c)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        """Yields the new connections until the server is closed."""
+        c = await self.newConn.get()
+        if c is _EOF:
+            self.newConn.put_nowait(_EOF)
+            raise StopAsyncIteration
+        return c
+
+    async def getConnection(self):
+        """Wait for a new connection and return it."""
+        return await self.__anext__()
+
+    def __len__(self):
+        """The number of active connections."""
+        return len(self.connections)
+
+    def getConnectionsList(self):
+        """
+        Returns the list of all the active AsyncConnection objects of the
+        server.
+        """
+        return self.connections[:]
+
+    def readableConnections(self):
+        """
+        Returns the list of the child AsyncConnection objects which have
+        data available to be read.
+        """
+        return [c for c in self.connections if c.isDataAvailable()]
+
+    async def close(self):
+        """
+        Closes the server only (no new connections). Its connections
+        remain functioning.
+        """
+        self.server.close()
+        self.newConn.put_nowait(_EOF)
+
+    async def closeServer(self):
+        """
+        Closes the server and all of its connections
+        """
+        for c in self.connections[:]:
+            c.close()
+        await self.close()
+        await self.server.wait_closed()
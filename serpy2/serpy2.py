@@ -42,32 +42,2636 @@
 # [^1]: blob = binary large object
 
 
+import os
+import sys
+import mmap
 import socket
 import threading
 import queue
 import select
-from time import sleep
+import selectors
+import collections
+import heapq
+import itertools
+import functools
+import traceback
+import bisect
+import http.server
+from concurrent.futures import Future, ThreadPoolExecutor
+import struct
+import zlib
+import bz2
+import lzma
+from time import sleep, monotonic, perf_counter_ns
 import warnings
 
+try:
+    import numpy as np
+except ImportError:
+    np = None # NumPy is optional, only needed to send/receive ndarrays
 
 
-STIMEOUT = 0.010 # This delay (in seconds) limits the rate with which new
-                 # blocks are sent/received/processed. Reducing it further
-                 # may speed up the rate of blocks sent/recvd, but will
-                 # likely increase processor usage. It is not clear if there is
-                 # a lower limit. 
-                 # 
-                 #
-#STIMEOUT = 2.0   # SLOW DEBUGGING MODE 
+
+STIMEOUT = 0.010 # The worker threads do not poll: they block until there
+                 # is work or until the Connection is closed. This delay 
+                 # (in seconds) is now only used as the default grace time
+                 # when iterating over the received data of a Connection.
 
 QUEUELEN = 20
 
-BLOCKIDCODE = b'\xDE\xCA\xFE\xCA\xFE'
-INTTYPECODE = b'\x01'
-FLOATTYPECODE = b'\x11'
-STRTYPECODE = b'\x21'
-RAWBYTESTYPECODE = b'\x81'
-HEADLEN = 14 # calculated by hand (5 + 1 + 4 + 4 bytes)
+BROADCAST_POLICIES = ('block', 'drop', 'disconnect') # see Server.broadcast
+QUEUE_POLICIES = ('block', 'latest', 'drop-oldest', 'drop-newest')
+
+BLOCKIDCODE = b'\xDE\xCA\xFE\xCA\xFE'
+INTTYPECODE = b'\x01'
+FLOATTYPECODE = b'\x11'
+STRTYPECODE = b'\x21'
+RAWBYTESTYPECODE = b'\x81'
+NDARRAYTYPECODE = b'\x91'
+# Compact binary encodings (see _encodeItem):
+VARINTTYPECODE = b'\x02' # int as a zigzag varint (any size)
+BOOLTYPECODE = b'\x03'
+NONETYPECODE = b'\x04'
+DOUBLETYPECODE = b'\x12' # float as an IEEE-754 binary64
+LISTTYPECODE = b'\x41'
+TUPLETYPECODE = b'\x42'
+DICTTYPECODE = b'\x43'
+EVENTSTYPECODE = b'\xA1' # EventBatch, columnar (see _encodeEvents)
+RPCTYPECODE = b'\x51' # request, reply or error of RPCClient/RPCDispatcher
+HEADLEN = 14 # calculated by hand (5 + 1 + 4 + 4 bytes)
+
+# Blocks not using the original 'sum' checksum are sent with an extended
+# header, which records the checksum algorithm:
+#   XBLOCKIDCODE (5) + type (1) + flags (1) + checksum algorithm (1)
+#   + checksum (4) + data length (4)
+XBLOCKIDCODE = b'\xDE\xCA\xFE\xCA\xF2'
+XHEADLEN = 16 # calculated by hand (5 + 1 + 1 + 1 + 4 + 4 bytes)
+
+# Data larger than CHUNKSIZE is sent as a message made of several frames
+# (extended blocks) of at most CHUNKSIZE bytes, which removes the 4 GiB
+# limit of the data length field. The frames of a message follow each
+# other on the wire and are marked with the flags of the extended header:
+#   first frame: FRAME_TOTAL | FRAME_MORE, the header is followed by the
+#                total length of the message (8 bytes)
+#   next frames: FRAME_CONT | FRAME_MORE
+#   last frame : FRAME_CONT
+# Each frame carries the checksum of its own payload.
+CHUNKSIZE = 1 << 26 # 64 MiB
+FRAME_MORE = 0x01  # more frames of the message follow
+FRAME_CONT = 0x02  # continues the message started by the previous frames
+FRAME_TOTAL = 0x04 # first frame, followed by the total length (8 bytes)
+
+# Blocks (or chunked messages) may be compressed, which is marked by the
+# FRAME_COMPRESSED flag of the extended header. The payload then starts
+# with the code of the compression codec (1 byte), followed by the 
+# compressed data.
+FRAME_COMPRESSED = 0x08
+
+# Blocks (or chunked messages) may be sent on a logical channel other than
+# the default channel 0, which is marked by the FRAME_CHANNEL flag. The
+# channel id (1 byte) then follows the header (and the total length). The
+# frames of a message are contiguous within its channel, but may be
+# interleaved with the frames of other channels (see ChannelQueue).
+FRAME_CHANNEL = 0x10
+NBCHANNELS = 256
+
+# The frames of a traced message (see the tracer of Connection) carry the
+# sequence number of the message given by the sender, marked by the 
+# FRAME_SEQ flag: 8 bytes following the header (and the total length and
+# the channel id), so that the receiver reports the same number.
+FRAME_SEQ = 0x20
+_MESSAGESEQ = itertools.count() # sequence numbers, unique in the process
+
+COMPRESSMIN = 1024 # data smaller than this (in bytes) is never compressed
+COMPRESSTYPES = (STRTYPECODE, RAWBYTESTYPECODE, NDARRAYTYPECODE)
+
+
+def _sumChecksum(data, value=0):
+    return (value + sum(data)) & 0xFFFFFFFF
+
+def _noChecksum(data, value=0):
+    return 0
+
+# Checksum algorithms for the integrity of the blocks. 
+# name: (code, function, initial value)
+# function(data, value) returns the checksum of data, continuing from the
+# checksum value of the preceding data (32 bits, like zlib.crc32).
+# More algorithms can be added with registerChecksum.
+CHECKSUMS = {
+    'none': (0, _noChecksum, 0),     # for trusted (loopback) links
+    'sum': (1, _sumChecksum, 0),     # original serpy2 checksum (default)
+    'crc32': (2, zlib.crc32, 0),
+    'adler32': (3, zlib.adler32, 1),
+    }
+_CHECKSUMCODES = {code: (name, func, init)
+                  for name, (code, func, init) in CHECKSUMS.items()}
+
+
+def registerChecksum(name, code, func, init=0):
+    """
+    Make a new checksum algorithm available to serpy2 Connections.
+    
+    name : name by which the algorithm is selected (e.g. Connection(checksum=name))
+    code : int (0-255) identifying the algorithm in the block headers.
+           It must be the same on both ends of a connection.
+    func : function(data, value) returning the (32 bits, unsigned) checksum
+           of the bytes-like object data, continuing from the checksum
+           value of the preceding data.
+    init : initial checksum value
+    """
+    if not 0 <= code <= 255:
+        raise ValueError("Checksum code must be in the range 0-255")
+    if code in _CHECKSUMCODES and _CHECKSUMCODES[code][0] != name:
+        raise ValueError("Checksum code {} already used by '{}'".format(
+                         code, _CHECKSUMCODES[code][0]))
+    CHECKSUMS[name] = (code, func, init)
+    _CHECKSUMCODES[code] = (name, func, init)
+
+
+def _boundedDecompress(decompressor):
+    """
+    A decompress(data, max_length) function over the streaming 
+    decompressors made by decompressor (e.g. zlib.decompressobj), which
+    never produces more than max_length bytes (None: no limit), so that a
+    small payload cannot expand into a huge buffer (decompression bomb).
+    Raises ValueError for data larger than max_length, or truncated.
+    """
+    def decompress(data, max_length=None):
+        d = decompressor()
+        if max_length is None:
+            out = d.decompress(data)
+        else:
+            out = d.decompress(data, max_length + 1)
+            if len(out) > max_length:
+                raise ValueError("data larger than max_message "
+                                 "({} bytes)".format(max_length))
+        if not d.eof:
+            raise ValueError("truncated compressed data")
+        return out
+    return decompress
+
+
+def _checkedDecompress(decompress):
+    """
+    A decompress(data, max_length) function over the function 
+    decompress(data), checking the size of the data once decompressed.
+    """
+    def checked(data, max_length=None):
+        out = decompress(data)
+        if max_length is not None and len(out) > max_length:
+            raise ValueError("data larger than max_message "
+                             "({} bytes)".format(max_length))
+        return out
+    return checked
+
+
+# Compression codecs. name: (code, compress, decompress)
+# compress(data) takes a bytes-like object and returns the compressed 
+# bytes, decompress(data, max_length) the decompressed bytes, raising 
+# ValueError rather than producing more than max_length bytes (None: no 
+# limit). More codecs can be added with registerCodec.
+CODECS = {
+    'zlib': (1, lambda data: zlib.compress(data, 1), 
+             _boundedDecompress(zlib.decompressobj)),
+    'bz2': (2, bz2.compress, _boundedDecompress(bz2.BZ2Decompressor)),
+    'lzma': (3, lzma.compress, _boundedDecompress(lzma.LZMADecompressor)),
+    }
+_CODECCODES = {code: (name, compress, decompress)
+               for name, (code, compress, decompress) in CODECS.items()}
+
+
+def registerCodec(name, code, compress, decompress, bounded=False):
+    """
+    Make a new compression codec available to serpy2 Connections, e.g.:
+        >>> import lz4.frame
+        >>> registerCodec('lz4', 10, lz4.frame.compress, lz4.frame.decompress)
+    
+    name : name by which the codec is selected (e.g. Connection(compress=name))
+    code : int (1-255) identifying the codec in the blocks.
+           It must be the same on both ends of a connection.
+    compress, decompress : functions taking a bytes-like object and 
+           returning the compressed (decompressed) data as bytes.
+    bounded : if True, decompress is called as decompress(data, max_length)
+           and must raise ValueError rather than produce more than 
+           max_length bytes (None: no limit), max_length being the 
+           max_message of the receiving Connection. If False (default),
+           the size of the data is only checked once decompressed, which 
+           does not protect the receiver from decompression bombs.
+    """
+    if not 1 <= code <= 255:
+        raise ValueError("Codec code must be in the range 1-255")
+    if code in _CODECCODES and _CODECCODES[code][0] != name:
+        raise ValueError("Codec code {} already used by '{}'".format(
+                         code, _CODECCODES[code][0]))
+    if not bounded:
+        decompress = _checkedDecompress(decompress)
+    CODECS[name] = (code, compress, decompress)
+    _CODECCODES[code] = (name, compress, decompress)
+
+
+def _checkCodecName(codec):
+    if codec is not None and codec not in CODECS:
+        raise ValueError("Unknown compression codec '{}'".format(codec))
+
+
+def _checkChecksumName(checksum):
+    if checksum not in CHECKSUMS:
+        raise ValueError("Unknown checksum algorithm '{}'".format(checksum))
+
+
+def _checkQueuePolicy(policy):
+    if policy not in QUEUE_POLICIES:
+        raise ValueError("Unknown queue policy '{}'".format(policy))
+
+
+def _checkChunkSize(chunksize):
+    # the length of a frame must fit in the 4 bytes of its header
+    if not 0 < chunksize < 1 << 32:
+        raise ValueError("chunksize must be in the range 1 - 2**32-1")
+
+RECVSIZE = 65536 # maximum number of bytes read from a socket in one go
+                 # (size of the receive staging buffers)
+MAXMESSAGE = 1 << 32 # largest message (in bytes) received in memory by
+                     # default: larger ones are dropped (see BlockParser)
+STREAMBUFFER = 1 << 20 # number of bytes of a BlockStream buffered before
+                       # the Connection stops reading from its socket
+
+ENGINES = ('threads', 'selector')
+
+HAVE_SENDMSG = hasattr(socket.socket, 'sendmsg') # not on Windows
+IOV_MAX = 1024 # maximum number of buffers in one sendmsg call
+HAVE_SENDFILE = hasattr(os, 'sendfile') # not on Windows
+HAVE_CORK = hasattr(socket, 'TCP_CORK') # Linux only
+FILEBUFFER = 1 << 20 # size of the reads from files, when they are needed
+SMALLBLOCK = 4096 # payloads smaller than this (in bytes) are copied behind
+                  # their header instead of being written separately
+
+
+
+def _encodeNdarray(arr):
+    """
+    Encode a NumPy ndarray as a list of payload parts: a sub-header
+    describing the array, followed by the memory of the array itself
+    (no copy, unless the array is not C-contiguous).
+    
+    Sub-header (little endian):
+      length of dtype string (1) + dtype string (ascii, e.g. '<f4', 
+      includes the byte order) + number of dimensions (1)
+      + shape (8 bytes per dimension) + padding
+    The sub-header is padded to a multiple of 16 bytes, so that the array
+    data is aligned in the receive buffer.
+    
+    Supported dtypes are those described by their dtype string: bool, 
+    integers, floats, complex, datetime64, timedelta64, bytes (S), 
+    unicode (U) and unstructured void (V). Raises TypeError for structured
+    dtypes (with fields) and object dtypes.
+    """
+    if arr.dtype.hasobject:
+        raise TypeError("Cannot send ndarray of Python objects")
+    if arr.dtype.fields is not None:
+        raise TypeError("Cannot send ndarray of structured dtype")
+    if not arr.flags.c_contiguous:
+        arr = np.ascontiguousarray(arr)
+    dstr = arr.dtype.str.encode('ascii')
+    shead = bytes((len(dstr),)) + dstr + bytes((arr.ndim,)) \
+            + b''.join(n.to_bytes(8, 'little', signed=False) 
+                       for n in arr.shape)
+    shead += bytes(-len(shead) % 16)
+    if not arr.size:
+        return [shead] # memoryview cannot flatten an empty array
+    if arr.dtype.kind in 'Mm':
+        # datetime64 and timedelta64 do not export a buffer
+        return [shead, arr.reshape(-1).view(np.uint8)]
+    return [shead, arr]
+
+
+def _decodeNdarray(bdata):
+    """
+    Rebuild a NumPy ndarray from the payload of a NDARRAYTYPECODE block.
+    The array is a view over the receive buffer bdata (no copy).
+    """
+    if np is None:
+        raise TypeError("Received ndarray, but NumPy is not available")
+    view = memoryview(bdata)
+    dlen = view[0]
+    dstr = bytes(view[1:1+dlen]).decode('ascii')
+    ndim = view[1+dlen]
+    i = 2 + dlen
+    shape = tuple(int.from_bytes(view[i+8*k:i+8*k+8], 'little', signed=False)
+                  for k in range(ndim))
+    i += 8 * ndim
+    i += -i % 16 # padding
+    arr = np.frombuffer(bdata, dtype=np.dtype(dstr), offset=i)
+    return arr.reshape(shape)
+
+
+_DOUBLE = struct.Struct('<d')
+
+
+def _uvarint(n, out):
+    """Append the unsigned int n to the bytearray out as a LEB128 varint."""
+    while n > 0x7F:
+        out.append((n & 0x7F) | 0x80)
+        n >>= 7
+    out.append(n)
+
+
+def _readUvarint(view, i):
+    """Read a LEB128 varint at index i of view. Returns (n, next index)."""
+    n = shift = 0
+    while True:
+        b = view[i]
+        i += 1
+        n |= (b & 0x7F) << shift
+        if b < 0x80:
+            return n, i
+        shift += 7
+
+
+def _encodeInt(x, out):
+    _uvarint(x << 1 if x >= 0 else (-x << 1) - 1, out) # zigzag
+
+def _encodeDouble(x, out):
+    out += _DOUBLE.pack(x)
+
+def _encodeBool(x, out):
+    out.append(x)
+
+def _encodeNone(x, out):
+    pass
+
+def _encodeStr(x, out):
+    b = x.encode('utf-8')
+    _uvarint(len(b), out)
+    out += b
+
+def _encodeBytes(x, out):
+    _uvarint(len(x), out)
+    out += x
+
+def _encodeSequence(x, out):
+    _uvarint(len(x), out)
+    for item in x:
+        _encodeItem(item, out)
+
+def _encodeDict(x, out):
+    _uvarint(len(x), out)
+    for key, value in x.items():
+        _encodeItem(key, out)
+        _encodeItem(value, out)
+
+def _encodeArray(x, out):
+    parts = _payloadParts(_encodeNdarray(x))
+    _uvarint(sum(len(p) for p in parts), out)
+    for p in parts:
+        out += p
+
+# type: (type code, function appending the encoded object to a bytearray)
+_ITEMENCODERS = {
+    int: (VARINTTYPECODE, _encodeInt),
+    float: (DOUBLETYPECODE, _encodeDouble),
+    bool: (BOOLTYPECODE, _encodeBool),
+    type(None): (NONETYPECODE, _encodeNone),
+    str: (STRTYPECODE, _encodeStr),
+    bytes: (RAWBYTESTYPECODE, _encodeBytes),
+    list: (LISTTYPECODE, _encodeSequence),
+    tuple: (TUPLETYPECODE, _encodeSequence),
+    dict: (DICTTYPECODE, _encodeDict),
+    }
+if np is not None:
+    _ITEMENCODERS[np.ndarray] = (NDARRAYTYPECODE, _encodeArray)
+
+
+def _encodeItem(x, out):
+    """
+    Append the object x, preceded by its type code, to the bytearray out.
+    The items of lists, tuples and dicts are encoded this way, after the
+    number of items (varint):
+        int: zigzag varint            float: IEEE-754 binary64
+        bool: 1 byte                  None: nothing
+        str, bytes, ndarray: length of the payload (varint) + payload
+        list, tuple: items            dict: key, value, key, value...
+    NumPy scalars are encoded as the Python objects they hold, other 
+    buffers as bytes.
+    """
+    try:
+        code, encode = _ITEMENCODERS[type(x)]
+    except KeyError:
+        if np is not None and isinstance(x, np.generic):
+            _encodeItem(x.item(), out)
+            return
+        try:
+            x = memoryview(x).cast('B')
+        except TypeError:
+            raise TypeError("Unsupported data type {} in container. "
+                            "Cannot Send".format(type(x))) from None
+        code, encode = RAWBYTESTYPECODE, _encodeBytes
+    out += code
+    encode(x, out)
+
+
+def _decodeInt(view, i):
+    n, i = _readUvarint(view, i)
+    return (n >> 1) ^ -(n & 1), i
+
+def _decodeDouble(view, i):
+    return _DOUBLE.unpack_from(view, i)[0], i + 8
+
+def _decodeBool(view, i):
+    return view[i] != 0, i + 1
+
+def _decodeNone(view, i):
+    return None, i
+
+def _decodeStr(view, i):
+    n, i = _readUvarint(view, i)
+    return str(view[i:i+n], 'utf-8'), i + n
+
+def _decodeBytes(view, i):
+    n, i = _readUvarint(view, i)
+    return bytes(view[i:i+n]), i + n
+
+def _decodeArray(view, i):
+    n, i = _readUvarint(view, i)
+    return _decodeNdarray(view[i:i+n]), i + n
+
+def _decodeList(view, i):
+    n, i = _readUvarint(view, i)
+    items = []
+    for k in range(n):
+        item, i = _decodeItem(view, i)
+        items.append(item)
+    return items, i
+
+def _decodeTuple(view, i):
+    items, i = _decodeList(view, i)
+    return tuple(items), i
+
+def _decodeDict(view, i):
+    n, i = _readUvarint(view, i)
+    d = {}
+    for k in range(n):
+        key, i = _decodeItem(view, i)
+        d[key], i = _decodeItem(view, i)
+    return d, i
+
+# type code (int): function(view, i) returning (object, next index)
+_ITEMDECODERS = {
+    VARINTTYPECODE[0]: _decodeInt,
+    DOUBLETYPECODE[0]: _decodeDouble,
+    BOOLTYPECODE[0]: _decodeBool,
+    NONETYPECODE[0]: _decodeNone,
+    STRTYPECODE[0]: _decodeStr,
+    RAWBYTESTYPECODE[0]: _decodeBytes,
+    NDARRAYTYPECODE[0]: _decodeArray,
+    LISTTYPECODE[0]: _decodeList,
+    TUPLETYPECODE[0]: _decodeTuple,
+    DICTTYPECODE[0]: _decodeDict,
+    }
+
+
+def _decodeItem(view, i):
+    """Decode the item encoded by _encodeItem at index i of view."""
+    try:
+        decode = _ITEMDECODERS[view[i]]
+    except KeyError:
+        raise TypeError("Received data of unsupported type") from None
+    return decode(view, i + 1)
+
+class EventBatch:
+    """
+    A batch of events (e.g. photons detected by time-tagging electronics):
+    their timestamps (int, sorted in increasing order, in the unit of the
+    instrument) and, optionally, the channel ids of the events (int, 0 to
+    65535).
+    
+    times and channels are NumPy arrays (int64, and uint8 or uint16) if
+    NumPy is available, lists otherwise.
+    
+    An EventBatch is sent as one block (EVENTSTYPECODE), encoded in 
+    columns: the first timestamp, then the differences between successive
+    timestamps, then the channel ids.
+    """
+    __slots__ = ('times', 'channels')
+
+    def __init__(self, times, channels=None):
+        if np is not None:
+            times = np.ascontiguousarray(times, dtype=np.int64)
+            if channels is not None:
+                channels = np.asarray(channels)
+                cmax = int(channels.max()) if channels.size else 0
+                if channels.size and (channels.min() < 0 or cmax > 0xFFFF):
+                    raise ValueError("Channel ids must be in 0..65535")
+                channels = np.ascontiguousarray(channels,
+                    dtype=np.uint16 if cmax > 0xFF else np.uint8)
+        else:
+            times = list(times)
+            if channels is not None:
+                channels = list(channels)
+                if any(not 0 <= c <= 0xFFFF for c in channels):
+                    raise ValueError("Channel ids must be in 0..65535")
+        if channels is not None and len(channels) != len(times):
+            raise ValueError("There must be one channel id per event")
+        self.times = times
+        self.channels = channels
+
+    def __len__(self):
+        return len(self.times)
+
+    def __repr__(self):
+        return 'EventBatch({} events{})'.format(
+            len(self), '' if self.channels is None else ', with channels')
+
+
+# Encodings of the event batches: 
+EVENTS_VARINT = 0 # differences and channel ids as LEB128 varints
+EVENTS_PACKED = 1 # as packed arrays of fixed-width little-endian integers
+_EVENTSHEAD = struct.Struct('<BBQq') # encoding, has channels, count, first
+_EVENTSWIDTHS = struct.Struct('<BB') # width of differences, of channel ids
+
+
+def _encodeEvents(batch):
+    """
+    Encode the EventBatch batch as the payload of an EVENTSTYPECODE block:
+        encoding (1) + has channels (1) + number of events (8)
+        + first timestamp (8, signed)
+    then, for EVENTS_PACKED (if NumPy is available):
+        width of the differences (1: 1, 2, 4 or 8 bytes)
+        + width of the channel ids (1: 1 or 2 bytes)
+        + differences (unsigned) + channel ids
+    or, for EVENTS_VARINT:
+        differences (varints) + channel ids (varints)
+    There are one difference less than events. All integers are little
+    endian. Raises ValueError if the timestamps are not sorted, or do not
+    fit in 64 bits (signed).
+    """
+    times, channels = batch.times, batch.channels
+    n = len(times)
+    first = int(times[0]) if n else 0
+    if np is not None:
+        if not np.all(times[1:] >= times[:-1]):
+            raise ValueError("Event timestamps must be sorted")
+        # the differences of sorted int64 timestamps fit in a uint64, but
+        # not always in an int64 (e.g. [-5, 2**63-1])
+        deltas = np.diff(times.view(np.uint64))
+        dmax = int(deltas.max()) if len(deltas) else 0
+        dwidth = 1 if dmax <= 0xFF else 2 if dmax <= 0xFFFF \
+                 else 4 if dmax <= 0xFFFFFFFF else 8
+        cwidth = 0 if channels is None else channels.itemsize
+        parts = [_EVENTSHEAD.pack(EVENTS_PACKED, channels is not None, 
+                                  n, first)
+                 + _EVENTSWIDTHS.pack(dwidth, cwidth)]
+        if len(deltas):
+            parts.append(deltas.astype('<u{}'.format(dwidth)))
+        if n and channels is not None:
+            parts.append(channels.astype(channels.dtype.newbyteorder('<'),
+                                         copy=False))
+        return parts
+    out = bytearray(_EVENTSHEAD.pack(EVENTS_VARINT, channels is not None,
+                                     n, first))
+    prev = first
+    for t in times[1:]:
+        if t < prev:
+            raise ValueError("Event timestamps must be sorted")
+        if t > 0x7FFFFFFFFFFFFFFF:
+            raise ValueError("Event timestamps must fit in 64 bits")
+        _uvarint(t - prev, out)
+        prev = t
+    if channels is not None:
+        for c in channels:
+            _uvarint(c, out)
+    return out
+
+
+def _decodeEvents(bdata):
+    """Rebuild an EventBatch from the payload of an EVENTSTYPECODE block."""
+    view = _byteView(bdata)
+    encoding, haschannels, n, first = _EVENTSHEAD.unpack_from(view, 0)
+    i = _EVENTSHEAD.size
+    nd = max(n - 1, 0)
+    if nd > len(view) - i:
+        # at least one byte per event: do not trust a count this large
+        raise ValueError("Malformed event batch payload")
+    if encoding == EVENTS_PACKED:
+        dwidth, cwidth = _EVENTSWIDTHS.unpack_from(view, i)
+        i += _EVENTSWIDTHS.size
+        if not haschannels:
+            cwidth = 0
+        if dwidth not in (1, 2, 4, 8) or cwidth not in (0, 1, 2, 4, 8) or \
+           bool(cwidth) != bool(haschannels) or \
+           i + nd * dwidth + n * cwidth != len(view):
+            raise ValueError("Malformed event batch payload")
+        if np is not None:
+            deltas = np.frombuffer(view, '<u{}'.format(dwidth), nd, i)
+            times = np.empty(n, np.int64)
+            if n:
+                times[0] = first
+                np.cumsum(deltas, dtype=np.int64, out=times[1:])
+                times[1:] += first
+            i += nd * dwidth
+            channels = np.frombuffer(view, '<u{}'.format(cwidth), n, i) \
+                       if haschannels else None
+            return EventBatch(times, channels)
+        fmt = {1: '<B', 2: '<H', 4: '<I', 8: '<Q'}
+        deltas = struct.unpack_from('<{}{}'.format(nd, fmt[dwidth][1]), 
+                                    view, i)
+        i += nd * dwidth
+        times = [first] * n
+        for k in range(nd):
+            times[k+1] = times[k] + deltas[k]
+        channels = list(struct.unpack_from('<{}{}'.format(
+                        n, fmt[cwidth][1]), view, i)) if haschannels else None
+        return EventBatch(times, channels)
+    if encoding != EVENTS_VARINT:
+        raise TypeError("Received event batch of unsupported encoding")
+    times = [first] * n
+    for k in range(nd):
+        d, i = _readUvarint(view, i)
+        times[k+1] = times[k] + d
+    channels = None
+    if haschannels:
+        channels = [0] * n
+        for k in range(n):
+            channels[k], i = _readUvarint(view, i)
+    if i != len(view):
+        raise ValueError("Malformed event batch payload")
+    return EventBatch(times, channels)
+
+
+# Kinds of RPC messages
+RPC_REQUEST = 0
+RPC_REPLY = 1
+RPC_ERROR = 2
+
+
+class RPCError(Exception):
+    """The remote handler of an RPC call raised an exception."""
+
+
+class _RPCMessage:
+    """
+    A message of the RPC layer (see RPCClient and RPCDispatcher):
+        RPC_REQUEST: value is the tuple of arguments of the method called
+        RPC_REPLY  : value is the result of the call
+        RPC_ERROR  : value is the error message (str)
+    rid is the id of the request, repeated in its reply.
+    """
+    __slots__ = ('kind', 'rid', 'method', 'value')
+
+    def __init__(self, kind, rid, method, value):
+        self.kind = kind
+        self.rid = rid
+        self.method = method
+        self.value = value
+
+
+def _encodeRPC(msg):
+    """
+    Encode the _RPCMessage msg as the payload of an RPCTYPECODE block:
+        kind (1) + request id (varint) 
+        + [method name (str item), for requests] + value (item)
+    (items as encoded by _encodeItem)
+    """
+    out = bytearray((msg.kind,))
+    _uvarint(msg.rid, out)
+    if msg.kind == RPC_REQUEST:
+        _encodeItem(msg.method, out)
+        _encodeItem(tuple(msg.value), out)
+    else:
+        _encodeItem(msg.value, out)
+    return out
+
+
+def _decodeRPC(bdata):
+    """Rebuild an _RPCMessage from the payload of an RPCTYPECODE block."""
+    view = _byteView(bdata)
+    kind = view[0]
+    if kind not in (RPC_REQUEST, RPC_REPLY, RPC_ERROR):
+        raise TypeError("Received RPC message of unsupported kind")
+    rid, i = _readUvarint(view, 1)
+    method = None
+    if kind == RPC_REQUEST:
+        method, i = _decodeItem(view, i)
+    value, i = _decodeItem(view, i)
+    if i != len(view):
+        raise ValueError("Malformed RPC message payload")
+    return _RPCMessage(kind, rid, method, value)
+
+
+def _encodeData(data, compact=False):
+    """
+    Encode a Python object into a (bdata, btype) pair, where bdata is the 
+    payload of the block and btype its one-byte type code.
+    The payload is a bytes-like object, or a list of bytes-like objects
+    (parts of the payload, to be sent one after the other).
+    
+    If compact is True, int and float are sent in the compact binary 
+    encodings (VARINTTYPECODE, DOUBLETYPECODE), which peers older than
+    these type codes cannot decode. bool, None, list, tuple and dict are
+    always sent in the compact encodings.
+    
+    Raises TypeError for unsupported data types.
+    """
+    # `if type(data) is` vs `isinstance()`...
+    # See: https://switowski.com/blog/type-vs-isinstance
+    # Thanks to Arthur for pointing this out.
+    # Here, we choose the data to be necessarily *exactly* of the unmodified class.
+    # Subclasses not accepted. This behaviour can always be changed later on if required.
+    if type(data) is float:
+        if compact:
+            bdata = _DOUBLE.pack(data)
+            btype = DOUBLETYPECODE
+        else:
+            flhex = data.hex()
+            bdata = flhex.encode('ascii')
+            btype = FLOATTYPECODE
+    elif type(data) is int:
+        if compact:
+            bdata = bytearray()
+            _encodeInt(data, bdata)
+            btype = VARINTTYPECODE
+        else:
+            bdata = data.to_bytes(8, 'little', signed = True)
+            btype = INTTYPECODE
+    elif type(data) in _COMPACTTYPES:
+        # bool, None and containers: the payload is their _encodeItem
+        # encoding, without the type code
+        btype, encode = _ITEMENCODERS[type(data)]
+        bdata = bytearray()
+        encode(data, bdata)
+    elif type(data) is str:
+        bdata = data.encode('utf-8')
+        btype = STRTYPECODE
+    elif type(data) is bytes:
+        bdata = data
+        btype = RAWBYTESTYPECODE
+    elif np is not None and type(data) is np.ndarray:
+        bdata = _encodeNdarray(data)
+        btype = NDARRAYTYPECODE
+    elif type(data) is EventBatch:
+        bdata = _encodeEvents(data)
+        btype = EVENTSTYPECODE
+    elif type(data) is _RPCMessage:
+        bdata = _encodeRPC(data)
+        btype = RPCTYPECODE
+    elif np is not None and isinstance(data, np.generic):
+        # NumPy scalars export a buffer, but are sent as the Python 
+        # objects they hold, not as their raw bytes
+        return _encodeData(data.item(), compact)
+    else:
+        # Any other object exporting a C-contiguous buffer (bytearray,
+        # memoryview, array.array, mmap, ctypes...) is sent as raw data,
+        # directly from its own memory
+        try:
+            view = memoryview(data)
+        except TypeError:
+            raise TypeError("Unsupported data type. Cannot Send") from None
+        if not view.c_contiguous:
+            raise TypeError("Cannot send a non-contiguous buffer")
+        bdata = data if view.nbytes else b''
+        btype = RAWBYTESTYPECODE
+    return bdata, btype
+
+
+_COMPACTTYPES = (bool, type(None), list, tuple, dict)
+_COMPACTCODES = (VARINTTYPECODE, DOUBLETYPECODE, BOOLTYPECODE, NONETYPECODE,
+                   LISTTYPECODE, TUPLETYPECODE, DICTTYPECODE)
+
+
+def _decodeData(btype, bdata):
+    """
+    Decode the payload bdata of a block of type btype back into the
+    original Python object.
+    
+    Raises TypeError for unsupported type codes or codecs, ValueError for
+    data that cannot be decompressed or is malformed (e.g. truncated).
+    """
+    if type(bdata) is _Compressed:
+        bdata = bdata.decompress()
+        if btype == NDARRAYTYPECODE and type(bdata) is bytes:
+            bdata = bytearray(bdata) # for a writable array
+    try:
+        return _decodePayload(btype, bdata)
+    except (IndexError, struct.error, RecursionError):
+        # read past the end of the payload, or nested too deep
+        raise ValueError("Malformed payload of type 0x{:02X}".format(
+                         btype[0])) from None
+
+
+def _decodePayload(btype, bdata):
+    """Decode the (decompressed) payload bdata (see _decodeData)."""
+    if btype == FLOATTYPECODE:
+        data = float.fromhex(str(bdata, 'ascii'))
+    elif btype == INTTYPECODE:
+        data = int.from_bytes(bdata, 
+                              'little', signed = True)
+    elif btype == STRTYPECODE:
+        data = str(bdata, 'utf-8')
+    elif btype == RAWBYTESTYPECODE:
+        if type(bdata) is memoryview or type(bdata) is BlockStream:
+            data = bdata # pooled buffer (see BufferPool) or stream: 
+                         # not copied
+        else:
+            data = bytes(bdata) # no copy if bdata is already bytes
+    elif btype == NDARRAYTYPECODE:
+        data = _decodeNdarray(bdata)
+    elif btype in _COMPACTCODES:
+        view = memoryview(bdata)
+        data, i = _ITEMDECODERS[btype[0]](view, 0)
+        if i != len(view):
+            raise ValueError("Malformed compact payload")
+    elif btype == EVENTSTYPECODE:
+        data = _decodeEvents(bdata)
+    elif btype == RPCTYPECODE:
+        data = _decodeRPC(bdata)
+    else:
+        raise TypeError("Received data of unsupported type")
+    return data
+
+
+class _Compressed:
+    """
+    The payload of a compressed block, as received: the codec code
+    followed by the compressed data. Decompressed by _decodeData, into at
+    most max_length bytes (None: no limit).
+    """
+    __slots__ = ('payload', 'max_length')
+
+    def __init__(self, payload, max_length=None):
+        self.payload = payload
+        self.max_length = max_length
+
+    def decompress(self):
+        view = memoryview(self.payload)
+        if not len(view) or view[0] not in _CODECCODES:
+            raise TypeError("Received data compressed with an unknown codec")
+        name, compress, decompress = _CODECCODES[view[0]]
+        try:
+            return decompress(view[1:], self.max_length)
+        except Exception as err:
+            raise ValueError("Cannot decompress received data ({})".format(
+                             err)) from None
+
+
+
+class _Traced:
+    """
+    Data received, queued with the sequence number of its message for
+    the tracer of the Connection (see Connection._getItem).
+    """
+    __slots__ = ('data', 'seq')
+
+    def __init__(self, data, seq):
+        self.data = data
+        self.seq = seq
+
+
+def _compressData(bdata, codec, minsize=COMPRESSMIN):
+    """
+    Compress the payload bdata with the codec codec if it is at least
+    minsize bytes long and the compression pays off. Returns the payload
+    to send and the frame flags (FRAME_COMPRESSED or 0).
+    """
+    parts = _payloadParts(bdata)
+    size = sum(len(p) for p in parts)
+    if size < minsize:
+        return bdata, 0
+    code, compress, decompress = CODECS[codec]
+    cdata = compress(parts[0] if len(parts) == 1 else b''.join(parts))
+    if len(cdata) + 1 >= size:
+        return bdata, 0 # incompressible
+    return [bytes((code,)), cdata], FRAME_COMPRESSED
+
+
+def _byteView(bdata):
+    """A flat memoryview of unsigned bytes over the buffer bdata."""
+    view = memoryview(bdata)
+    if view.format != 'B' or view.ndim != 1:
+        view = view.cast('B')
+    return view
+
+
+def _payloadParts(bdata):
+    """The payload bdata as a list of flat memoryviews of bytes."""
+    if type(bdata) is list:
+        return [_byteView(b) for b in bdata]
+    return [_byteView(bdata)]
+
+
+def _payloadSize(bdata):
+    """
+    The number of bytes of memory held by the payload bdata (file ranges
+    are not in memory).
+    """
+    if type(bdata) is _FileRange or type(bdata) is BlockStream:
+        return 0
+    if type(bdata) is _Compressed:
+        bdata = bdata.payload
+    return sum(p.nbytes for p in _payloadParts(bdata))
+
+
+def _framesSize(frames):
+    """The number of bytes of memory held by the frames of a message."""
+    return sum(len(bhead) + _payloadSize(bdata) for bhead, bdata in frames)
+
+
+def _queuedSize(item):
+    """The size of an item of the out_q of the engine 'threads'."""
+    bdata, btype, channel, tag = item
+    return _framesSize(bdata) if btype is None else _payloadSize(bdata)
+
+
+def _dataSize(data):
+    """
+    The approximate number of bytes of memory held by the object data,
+    as received (see ByteBudget).
+    """
+    if type(data) is _Traced:
+        data = data.data
+    if type(data) is BlockStream:
+        return 0 # at most STREAMBUFFER bytes, bounded by the stream itself
+    if type(data) is str:
+        return len(data)
+    try:
+        return memoryview(data).nbytes
+    except TypeError:
+        return sys.getsizeof(data)
+
+
+def _blockHeader(bdata, btype, checksum='sum', flags=0, total=None,
+                 channel=0, seq=None):
+    """
+    Build the header preceding the payload bdata on the wire: the original
+    HEADLEN bytes header for the 'sum' checksum, an XHEADLEN bytes
+    extended header recording the algorithm for the other checksums, or
+    for the frames of a chunked message (flags, and total length for the
+    first frame), or for the channels other than 0 (channel id), or for
+    traced messages (sequence number seq, with FRAME_SEQ).
+    """
+    parts = _payloadParts(bdata)
+    code, func, init = CHECKSUMS[checksum]
+    value = init
+    for p in parts:
+        value = func(p, value)
+    return _makeHeader(btype, checksum, value, sum(len(p) for p in parts),
+                       flags, total, channel, seq)
+
+
+def _makeHeader(btype, checksum, value, datalen, flags=0, total=None,
+                channel=0, seq=None):
+    """
+    The header of a block of datalen bytes, whose checksum (with the 
+    algorithm checksum) is value. See _blockHeader.
+    """
+    code = CHECKSUMS[checksum][0]
+    datalenb = datalen.to_bytes(4, 'little', signed = False)
+    datacheckb = (value & 0xFFFFFFFF).to_bytes(4, 'little', signed = False)
+    if checksum == 'sum' and not flags:
+        bhead = BLOCKIDCODE + btype + datacheckb + datalenb
+        assert len(bhead) == HEADLEN, 'HEADLEN incorrect'
+        return bhead
+    bhead = XBLOCKIDCODE + btype + bytes((flags, code)) \
+            + datacheckb + datalenb
+    assert len(bhead) == XHEADLEN, 'XHEADLEN incorrect'
+    if flags & FRAME_TOTAL:
+        bhead += total.to_bytes(8, 'little', signed=False)
+    if flags & FRAME_CHANNEL:
+        bhead += bytes((channel,))
+    if flags & FRAME_SEQ:
+        bhead += seq.to_bytes(8, 'little', signed=False)
+    return bhead
+
+
+def _splitParts(parts, chunksize):
+    """
+    Split the payload parts (memoryviews) into chunks of chunksize bytes,
+    each chunk being a list of memoryviews (no copy).
+    """
+    chunk, size = [], 0
+    for p in parts:
+        while len(p):
+            n = min(len(p), chunksize - size)
+            chunk.append(p[:n])
+            size += n
+            p = p[n:]
+            if size == chunksize:
+                yield chunk
+                chunk, size = [], 0
+    if chunk:
+        yield chunk
+
+
+def _encodeFrames(bdata, btype, checksum='sum', chunksize=CHUNKSIZE,
+                  flags=0, channel=0, seq=None):
+    """
+    The list of the (bhead, bdata) frames to send for the payload bdata:
+    a single block, or the frames of a chunked message if the payload is
+    larger than chunksize. flags are added to the flags of all the frames
+    (e.g. FRAME_COMPRESSED). The frames are marked with channel, if not 0,
+    and with the sequence number seq of the message, if not None.
+    """
+    if channel:
+        flags |= FRAME_CHANNEL
+    if seq is not None:
+        flags |= FRAME_SEQ
+    if type(bdata) is _FileRange:
+        return _fileFrames(bdata, btype, checksum, chunksize, flags, channel,
+                           seq)
+    parts = _payloadParts(bdata)
+    total = sum(len(p) for p in parts)
+    if total <= chunksize:
+        return [(_blockHeader(bdata, btype, checksum, flags, None, channel,
+                              seq), bdata)]
+    chunks = list(_splitParts(parts, chunksize))
+    return [(_blockHeader(chunk, btype, checksum, 
+                          _frameFlags(i, len(chunks)) | flags, total,
+                          channel, seq), chunk)
+            for i, chunk in enumerate(chunks)]
+
+
+def _frameFlags(i, nframes):
+    """The flags of the frame i of a message of nframes frames."""
+    if nframes == 1:
+        return 0
+    flags = FRAME_CONT if i else FRAME_TOTAL
+    if i < nframes - 1:
+        flags |= FRAME_MORE
+    return flags
+
+
+class _FileRange:
+    """
+    The payload made of count bytes of the open file f from offset, which
+    is written on the socket with sendfile (see Connection.sendFile). The
+    file is closed once the range is sent if close is True.
+    """
+    def __init__(self, f, offset, count, close=False):
+        self.file = f
+        self.offset = offset
+        self.count = count
+        self.close = close
+
+    def __len__(self):
+        return self.count
+
+    def checksum(self, checksum):
+        """The checksum of the range with the algorithm checksum."""
+        code, func, init = CHECKSUMS[checksum]
+        if func is _noChecksum or not self.count:
+            return func(b'', init)
+        value = init
+        buf = memoryview(bytearray(min(self.count, FILEBUFFER)))
+        self.file.seek(self.offset)
+        left = self.count
+        while left:
+            n = self.file.readinto(buf[:left])
+            if not n:
+                raise OSError("File shorter than expected")
+            value = func(buf[:n], value)
+            left -= n
+        return value
+
+    def send(self, sock):
+        """
+        Send as much of the range as possible on sock. Returns the number
+        of bytes sent. On a non-blocking socket, may raise BlockingIOError.
+        """
+        if HAVE_SENDFILE:
+            n = os.sendfile(sock.fileno(), self.file.fileno(), self.offset,
+                            self.count)
+        else:
+            self.file.seek(self.offset)
+            n = sock.send(self.file.read(min(self.count, FILEBUFFER)))
+        if not n:
+            raise OSError("File shorter than expected")
+        self.offset += n
+        self.count -= n
+        if not self.count and self.close:
+            self.file.close()
+        return n
+
+
+def _fileFrames(frange, btype, checksum, chunksize, flags=0, channel=0,
+                seq=None):
+    """The frames to send for the _FileRange frange (see _encodeFrames)."""
+    total = len(frange)
+    nframes = max(1, -(-total // chunksize))
+    frames = []
+    for i in range(nframes):
+        offset = i * chunksize
+        part = _FileRange(frange.file, frange.offset + offset,
+                          min(chunksize, total - offset),
+                          frange.close and i == nframes - 1)
+        frames.append((_makeHeader(btype, checksum, part.checksum(checksum),
+                                   len(part), _frameFlags(i, nframes) | flags,
+                                   total, channel, seq),
+                       part))
+    return frames
+
+
+
+def _frameBuffers(frames):
+    """
+    The list of buffers to write on the socket for the (bhead, bdata)
+    frames of a message (see _encodeFrames).
+    """
+    if len(frames) == 1:
+        return _blockBuffers(*frames[0])
+    return [v for bhead, bdata in frames for v in _blockBuffers(bhead, bdata)]
+
+
+def _blockBuffers(bhead, bdata):
+    """
+    The list of buffers to write on the socket for the block made of the
+    header bhead and the payload bdata. Small payloads are simply joined
+    to the header, which is cheaper than a vectored write.
+    """
+    if type(bdata) is _FileRange:
+        return [memoryview(bhead), bdata] if len(bdata) else [memoryview(bhead)]
+    if type(bdata) is bytes and len(bdata) < SMALLBLOCK:
+        return [memoryview(bhead + bdata)]
+    parts = _payloadParts(bdata)
+    if sum(len(p) for p in parts) < SMALLBLOCK:
+        return [memoryview(b''.join([bhead] + parts))]
+    return [memoryview(bhead)] + [p for p in parts if len(p)]
+
+
+def _joinSmall(views):
+    """
+    Join the consecutive small buffers of the list views into single
+    buffers, so that many small blocks are written with few iovecs.
+    """
+    out, run = [], []
+    for v in views:
+        if type(v) is not _FileRange and len(v) < SMALLBLOCK:
+            run.append(v)
+            continue
+        if run:
+            out.append(memoryview(b''.join(run)) if len(run) > 1 else run[0])
+            run = []
+        out.append(v)
+    if run:
+        out.append(memoryview(b''.join(run)) if len(run) > 1 else run[0])
+    return out
+
+
+def _sendBuffers(sock, views):
+    """
+    Send as much as possible of the list of buffers views (memoryviews of
+    bytes) on sock, with a single vectored write (sendmsg) if available.
+    The buffers are written as they are, without being concatenated.
+    File ranges (_FileRange) in the list are sent with sendfile.
+    
+    Returns the list of the views remaining to be sent, which is empty if
+    everything was sent. On a non-blocking socket, may raise
+    BlockingIOError.
+    """
+    if type(views[0]) is _FileRange:
+        views[0].send(sock)
+        return views[1:] if not len(views[0]) else views
+    k = 1
+    while k < len(views) and k < IOV_MAX and type(views[k]) is not _FileRange:
+        k += 1
+    if HAVE_SENDMSG:
+        n = sock.sendmsg(views[:k])
+    else:
+        n = sock.send(views[0])
+    # drop what has been sent
+    i = 0
+    while i < len(views) and n >= len(views[i]):
+        n -= len(views[i])
+        i += 1
+    views = views[i:]
+    if n:
+        views[0] = views[0][n:]
+    return views
+
+
+def _sendAll(sock, views):
+    """Send all the buffers views on the blocking socket sock."""
+    views = [v for v in views if len(v)]
+    while views:
+        views = _sendBuffers(sock, views)
+
+
+class BufferPool:
+    """
+    A pool of preallocated buffers into which a Connection receives the
+    payload of raw data and ndarray blocks, e.g. for streams of frames of
+    identical size. No memory is then allocated per block received.
+    
+    The buffers may be provided by the caller (any writable buffer:
+    bytearray, mmap, numpy array...) or allocated by the pool. A payload
+    is received into a free buffer large enough to hold it; if there is
+    none, a buffer is allocated as usual (counted in misses).
+    
+    Data received into a pooled buffer is delivered by getData as a
+    memoryview (raw data) or as a numpy array (ndarray) over the buffer.
+    Once done with it, hand the buffer back to the pool with release.
+    
+    Usage:
+        >>> pool = BufferPool.allocate(512*512*4 + 64, 8)
+        >>> c = Connection(pool=pool).connect(adr, port)
+        >>> img = c.getData()   # ndarray over a pooled buffer
+        >>> ...
+        >>> pool.release(img)
+    """
+    def __init__(self, buffers):
+        self.buffers = list(buffers)
+        self.free = collections.deque(self.buffers)
+        self._pooled = {id(b): b for b in self.buffers}
+        self._inuse = set()
+        self.lock = threading.Lock()
+        self.misses = 0
+
+    @classmethod
+    def allocate(cls, size, count):
+        """Create a pool of count buffers (bytearray) of size bytes."""
+        return cls(bytearray(size) for i in range(count))
+
+    def get(self, btype, size):
+        """
+        Returns a free buffer for a payload of size bytes of the block type
+        btype, or None.
+        """
+        if btype != RAWBYTESTYPECODE and btype != NDARRAYTYPECODE:
+            return None
+        with self.lock:
+            for i in range(len(self.free)):
+                buf = self.free.popleft()
+                if memoryview(buf).nbytes >= size:
+                    self._inuse.add(id(buf))
+                    return buf
+                self.free.append(buf)
+            self.misses += 1
+        return None
+
+    def release(self, data):
+        """
+        Hand the pooled buffer underlying data (as delivered by getData, or
+        the buffer itself) back to the pool. Data that was not received
+        into a pooled buffer is ignored.
+        """
+        # follow the chain ndarray -> ndarray.base -> memoryview.obj
+        obj = data
+        while obj is not None and id(obj) not in self._pooled:
+            if isinstance(obj, memoryview):
+                obj = obj.obj
+            else:
+                obj = getattr(obj, 'base', None)
+        if obj is None or self._pooled[id(obj)] is not obj:
+            return
+        with self.lock:
+            if id(obj) in self._inuse:
+                self._inuse.discard(id(obj))
+                self.free.append(obj)
+
+
+
+class BlockStream:
+    """
+    The payload of a raw data message delivered while it is being received
+    (see Connection.getStream), as a read-only file-like object. Iterating
+    over it yields the chunks of the payload (bytes) as they arrive.
+    
+    The integrity of the payload is verified once it has been fully
+    received: reading past its end raises IOError if the checksum is
+    wrong, ConnectionError if the connection was lost in the mean time.
+    
+    At most about STREAMBUFFER bytes are buffered: the connection stops
+    reading from its socket until they are read. A stream must therefore
+    be read, or closed (the rest of its data is then discarded), before
+    the messages following it can be received.
+    
+    Usage:
+        >>> with c.getStream() as s:
+        ...     for chunk in s:
+        ...         f.write(chunk)
+    """
+    def __init__(self, size, maxbuffer=STREAMBUFFER):
+        self.size = size # total length of the payload
+        self.maxbuffer = maxbuffer
+        self._chunks = collections.deque()
+        self._queued = 0 # number of bytes in _chunks
+        self._cond = threading.Condition()
+        self._done = False # all the payload has been received
+        self._error = None # raised at the end of the stream
+        self._onRoom = None # called when a full stream has room again
+        self.closed = False
+
+    @classmethod
+    def fromData(cls, data):
+        """A complete BlockStream of the bytes-like object data."""
+        stream = cls(len(data))
+        if len(data):
+            stream._put(data)
+        stream._finish()
+        return stream
+
+    # --- receiving end (called by the Connection) ---
+
+    def _put(self, chunk):
+        with self._cond:
+            if self.closed or self._done:
+                return
+            self._chunks.append(chunk)
+            self._queued += len(chunk)
+            self._cond.notify_all()
+
+    def _finish(self, error=None):
+        with self._cond:
+            if self._done:
+                return
+            self._done = True
+            self._error = error
+            self._cond.notify_all()
+
+    def _full(self):
+        return self._queued >= self.maxbuffer and not self.closed
+
+    def _waitRoom(self):
+        """Wait until the stream can take more data."""
+        with self._cond:
+            self._cond.wait_for(lambda: not self._full() or self._done)
+
+    # --- reading end ---
+
+    def _next(self):
+        """
+        Pop the next chunk, waiting for it. Returns None at the end of the
+        stream, or raises the error of the stream.
+        """
+        with self._cond:
+            if self.closed:
+                raise ValueError("I/O operation on closed BlockStream")
+            self._cond.wait_for(lambda: self._chunks or self._done)
+            if not self._chunks:
+                if self._error is not None:
+                    raise self._error
+                return None
+            was_full = self._full()
+            chunk = self._chunks.popleft()
+            self._queued -= len(chunk)
+            if was_full and not self._full():
+                self._cond.notify_all()
+            else:
+                was_full = False
+        if was_full and self._onRoom is not None:
+            self._onRoom()
+        return chunk
+
+    def _unread(self, chunk):
+        with self._cond:
+            self._chunks.appendleft(chunk)
+            self._queued += len(chunk)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        chunk = self._next()
+        if chunk is None:
+            raise StopIteration
+        return chunk
+
+    def read(self, n=-1):
+        """
+        Read and return up to n bytes (all the remaining payload if n is 
+        negative or omitted). Returns b'' at the end of the stream.
+        """
+        if n is None or n < 0:
+            return b''.join(self)
+        chunk = self._next() if n else b''
+        if chunk is None:
+            return b''
+        if len(chunk) > n:
+            self._unread(chunk[n:])
+            chunk = chunk[:n]
+        return bytes(chunk)
+
+    def readinto(self, b):
+        """
+        Read bytes into the writable buffer b. Returns the number of bytes
+        read, 0 at the end of the stream.
+        """
+        view = _byteView(b)
+        chunk = self.read(len(view))
+        view[:len(chunk)] = chunk
+        return len(chunk)
+
+    def readable(self):
+        return True
+
+    def close(self):
+        """Discard the rest of the payload."""
+        with self._cond:
+            self.closed = True
+            self._chunks.clear()
+            self._queued = 0
+            self._cond.notify_all()
+        if self._onRoom is not None:
+            self._onRoom()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+
+class BlockParser:
+    """
+    Incremental parser assembling the blocks of the serpy2 protocol from
+    a stream of bytes.
+    
+    Bytes can be fed as they come (feed), or received directly into the
+    buffers of the parser (getBuffer/bufferUpdated), which avoids copies:
+    data is received into a preallocated staging buffer, and large
+    payloads are received straight into a buffer sized from their header.
+    
+    Payloads are received into the buffers of the optional BufferPool
+    pool when possible.
+    
+    The frames of a chunked message are received straight into a single
+    buffer of the total length of the message, which is returned as one
+    block (bdata is then a memoryview) once its last frame is received.
+    The messages of different channels may be interleaved: the message
+    being received on a channel is set aside while frames of another
+    channel arrive.
+    
+    Raw data of at least stream_size bytes (if not None) is returned as
+    soon as its header is received, as a BlockStream fed with the payload
+    as it arrives. The checksum is then verified at the end of the stream.
+    
+    The sizes read from the headers are not trusted: messages (or blocks)
+    larger than max_message bytes (None: no limit), or for which there is
+    not enough memory, are dropped with a warning, their payload being
+    skipped as it arrives. Compressed data is dropped (see _decodeData) if
+    it decompresses to more than max_message bytes. Streamed data is not 
+    limited.
+    
+    Every complete block present in the buffered data is returned at once,
+    as a (btype, bdata, channel) tuple where bdata is a bytearray. The blocks are
+    verified with the checksum algorithm recorded in their header; blocks
+    with a wrong checksum, or an unknown algorithm, are dropped with a
+    warning. The payload of compressed blocks is returned as a _Compressed
+    object, decompressed by _decodeData.
+    
+    The optional tracer is called as tracer(stage, seq, t) as the messages
+    are received (TRACE_FIRSTBYTE, TRACE_FRAME, TRACE_CHECKSUM), seq 
+    being the sequence number sent with the message (see FRAME_SEQ) or,
+    if there is none, numbering the messages in the order they start, 
+    and t being a time.perf_counter_ns() timestamp. blockseqs is then the list of the 
+    sequence numbers of the blocks returned by bufferUpdated.
+    
+    Usage:
+     - To parse bytes obtained in any way:
+        >>> p = BlockParser()
+        >>> for btype, bdata, channel in p.feed(data):
+        ...     print(_decodeData(btype, bdata))
+    
+     - To receive from a socket without intermediate copies:
+        >>> n = sock.recv_into(p.getBuffer())
+        >>> blocks = p.bufferUpdated(n)
+    """
+    def __init__(self, bufsize=RECVSIZE, pool=None, stream_size=None,
+                 tracer=None, max_message=MAXMESSAGE):
+        self.pool = pool
+        self.stream_size = stream_size
+        self.max_message = max_message
+        self.skipping = False # True while skipping the payload of a frame
+        self.stream = None # BlockStream of the message being received
+        self.value = 0 # running checksum of a streamed payload
+        self.pooled = None # pooled buffer of the block being received
+        self.buf = bytearray(bufsize)
+        self.view = memoryview(self.buf)
+        self.start = 0 # buf[start:end] holds the data not processed yet
+        self.end = 0
+        self.btype = None # type code of the block being received, or None
+        self.checksum = 0
+        self.algo = 1 # checksum algorithm code of the block
+        self.bdata = None
+        self.bview = None
+        self.got = 0 # number of payload bytes received so far
+        self.flags = 0 # frame flags of the block
+        self.msg = None # memoryview of the chunked message being received
+        self.msggot = 0 # number of bytes of the message received so far
+        self.msgpooled = None # pooled buffer of the message
+        self.channel = 0 # channel of the block being received
+        self.suspended = {} # channel: (msg, msggot, msgpooled, stream, 
+                            # msgseq) of the messages interrupted by
+                            # another channel
+        self.direct = False # True if getBuffer returned the payload buffer
+        self.frames = 0 # number of frames (blocks) received
+        self.tracer = tracer
+        self.seq = 0 # number of the next message without FRAME_SEQ
+        self.msgseq = None # sequence number of the message being received
+        self.blockseqs = []
+        self.t_recv = 0 # time at which the bytes being processed arrived
+        self.checksum_errors = 0
+        self.resyncs = 0
+
+    def getBuffer(self):
+        """
+        Returns a writable memoryview into which the next bytes of the
+        stream should be received. Call bufferUpdated(n) once n bytes have
+        been written into it.
+        """
+        if self.btype is not None and self.bdata is not None and \
+           self.start == self.end and \
+           len(self.bdata) - self.got >= len(self.buf):
+            # large payload: receive straight into the block buffer
+            self.direct = True
+            return self.bview[self.got:]
+        self.direct = False
+        # Any complete block has been processed already: what remains in
+        # the staging buffer is less than a header. Move it to the front.
+        if self.start:
+            rest = self.end - self.start
+            self.buf[:rest] = self.buf[self.start:self.end]
+            self.start = 0
+            self.end = rest
+        return self.view[self.end:]
+
+    def bufferUpdated(self, n):
+        """
+        Process n new bytes written into the buffer returned by getBuffer.
+        Returns the list of the blocks completed.
+        """
+        blocks = []
+        if self.tracer is not None:
+            self.blockseqs = []
+            self.t_recv = perf_counter_ns()
+        if self.direct:
+            self.direct = False
+            self.got += n
+            self._checkBlock(blocks)
+            return blocks
+        self.end += n
+        while True:
+            if self.btype is not None and self.bdata is None:
+                # State 2 (streamed): passing the payload to the stream,
+                # or skipping it
+                take = min(self.end - self.start, self.blen - self.got)
+                if take and not self.skipping:
+                    chunk = bytes(self.view[self.start:self.start+take])
+                    if self.algo in _CHECKSUMCODES:
+                        self.value = _CHECKSUMCODES[self.algo][1](
+                                         chunk, self.value)
+                    self.stream._put(chunk)
+                self.got += take
+                self.start += take
+                if not self._checkStreamed():
+                    break
+            elif self.btype is not None:
+                # State 2: receiving the payload of a block
+                take = min(self.end - self.start, len(self.bdata) - self.got)
+                self.bview[self.got:self.got+take] = \
+                    self.view[self.start:self.start+take]
+                self.got += take
+                self.start += take
+                if not self._checkBlock(blocks):
+                    break
+            else:
+                # State 1: waiting for a fresh block, starting with
+                # BLOCKIDCODE or XBLOCKIDCODE
+                if self.end - self.start < HEADLEN:
+                    break
+                magic = self.view[self.start:self.start+5]
+                if magic == BLOCKIDCODE:
+                    self._readHeader(blocks)
+                elif magic == XBLOCKIDCODE:
+                    headlen = XHEADLEN
+                    if self.view[self.start+6] & FRAME_TOTAL:
+                        headlen += 8
+                    if self.view[self.start+6] & FRAME_CHANNEL:
+                        headlen += 1
+                    if self.view[self.start+6] & FRAME_SEQ:
+                        headlen += 8
+                    if self.end - self.start < headlen:
+                        break
+                    self._readXHeader(blocks)
+                else:
+                    self._resync()
+        if self.start == self.end:
+            self.start = self.end = 0
+        return blocks
+
+    def feed(self, data):
+        """
+        Process the bytes-like object data. Returns the list of the blocks
+        completed.
+        """
+        blocks = []
+        data = memoryview(data).cast('B')
+        while len(data):
+            target = self.getBuffer()
+            n = min(len(target), len(data))
+            target[:n] = data[:n]
+            data = data[n:]
+            blocks += self.bufferUpdated(n)
+        return blocks
+
+    def _readHeader(self, blocks):
+        """Decode the header at the start of the staging buffer."""
+        i = self.start
+        self.btype = bytes(self.view[i+5:i+6])
+        self.checksum = int.from_bytes(self.view[i+6:i+10],
+                                       'little', signed=False)
+        datalenb = int.from_bytes(self.view[i+10:i+14],
+                                  'little', signed=False)
+        self.algo = 1 # 'sum'
+        self.flags = 0
+        self.start += HEADLEN
+        self._switchChannel(0)
+        if self.msg is not None or self.stream is not None:
+            self._dropMessage('interrupted')
+        if self.tracer is not None:
+            self._traceStart(None)
+        self._newBlock(datalenb, blocks)
+
+    def _readXHeader(self, blocks):
+        """Decode the extended header at the start of the staging buffer."""
+        i = self.start
+        self.btype = bytes(self.view[i+5:i+6])
+        self.flags = self.view[i+6]
+        self.algo = self.view[i+7]
+        self.checksum = int.from_bytes(self.view[i+8:i+12],
+                                       'little', signed=False)
+        datalenb = int.from_bytes(self.view[i+12:i+16],
+                                  'little', signed=False)
+        self.start += XHEADLEN
+        if self.flags & FRAME_TOTAL:
+            total = int.from_bytes(self.view[self.start:self.start+8],
+                                   'little', signed=False)
+            self.start += 8
+        channel = 0
+        if self.flags & FRAME_CHANNEL:
+            channel = self.view[self.start]
+            self.start += 1
+        seq = None
+        if self.flags & FRAME_SEQ:
+            seq = int.from_bytes(self.view[self.start:self.start+8],
+                                 'little', signed=False)
+            self.start += 8
+        self._switchChannel(channel)
+        if (self.msg is not None or self.stream is not None) and \
+           not self.flags & FRAME_CONT:
+            self._dropMessage('interrupted')
+        if self.tracer is not None and not self.flags & FRAME_CONT:
+            self._traceStart(seq)
+        if self.flags & FRAME_TOTAL:
+            self._newMessage(total, blocks)
+        self._newBlock(datalenb, blocks)
+
+    def _switchChannel(self, channel):
+        """
+        Set aside the message being received on the current channel, if
+        any, and resume the one of channel.
+        """
+        if channel == self.channel:
+            return
+        if self.msg is not None or self.stream is not None:
+            self.suspended[self.channel] = (self.msg, self.msggot,
+                                            self.msgpooled, self.stream,
+                                            self.msgseq)
+        self.msg, self.msggot, self.msgpooled, self.stream, self.msgseq = \
+            self.suspended.pop(channel, (None, 0, None, None, None))
+        self.channel = channel
+
+    def _traceStart(self, seq):
+        """
+        A message starts: take its sequence number seq given by the 
+        sender, or number it if None, and trace its first byte.
+        """
+        if seq is None:
+            seq = self.seq
+            self.seq += 1
+        self.msgseq = seq
+        self.tracer(TRACE_FIRSTBYTE, self.msgseq, self.t_recv)
+
+    def _append(self, blocks, btype, bdata):
+        """Append the block (btype, bdata) of the channel to blocks."""
+        blocks.append((btype, bdata, self.channel))
+        if self.tracer is not None:
+            self.blockseqs.append(self.msgseq)
+
+    def _streamed(self, size):
+        """True if a payload of size bytes should be streamed."""
+        return self.stream_size is not None and size >= self.stream_size \
+               and self.btype == RAWBYTESTYPECODE \
+               and not self.flags & FRAME_COMPRESSED
+
+    def _newMessage(self, total, blocks):
+        """Prepare the reception of a chunked message of total bytes."""
+        self.msggot = 0
+        if self._streamed(total):
+            self.stream = BlockStream(total)
+            self._append(blocks, self.btype, self.stream)
+            return
+        if not self._fits(total):
+            return # its frames are skipped
+        if self.pool is not None and not self.flags & FRAME_COMPRESSED:
+            self.msgpooled = self.pool.get(self.btype, total)
+        if self.msgpooled is not None:
+            self.msg = _byteView(self.msgpooled)[:total]
+            return
+        try:
+            self.msg = memoryview(bytearray(total))
+        except MemoryError:
+            print('WARNING: Dropping chunked message of {} bytes in serpy2 '
+                  '(out of memory).'.format(total))
+
+    def _fits(self, size):
+        """
+        Returns True if a message of size bytes may be received (see 
+        max_message), or warns that it is dropped.
+        """
+        if self.max_message is None or size <= self.max_message:
+            return True
+        print('WARNING: Dropping message of {} bytes in serpy2 (more than '
+              'max_message).'.format(size))
+        return False
+
+    def _dropMessage(self, reason):
+        """Give up the chunked message being received."""
+        print('WARNING: Dropping {} chunked message in serpy2.'.format(reason))
+        if self.msgpooled is not None:
+            self.pool.release(self.msgpooled)
+        if self.stream is not None:
+            self.stream._finish(IOError("Dropped {} chunked message".format(
+                                        reason)))
+        self.msg = self.msgpooled = self.stream = None
+
+    def _newBlock(self, datalenb, blocks):
+        """Prepare the reception of a payload of datalenb bytes."""
+        self.got = 0
+        if self.stream is not None and self.flags & (FRAME_TOTAL|FRAME_CONT):
+            if self.msggot + datalenb <= self.stream.size:
+                self._newStreamed(datalenb)
+                return
+            self._dropMessage('oversized')
+        elif self.stream is None and not self.flags & FRAME_CONT and \
+             self._streamed(datalenb):
+            self.stream = BlockStream(datalenb)
+            self._append(blocks, self.btype, self.stream)
+            self._newStreamed(datalenb)
+            return
+        if self.msg is not None and self.flags & (FRAME_TOTAL|FRAME_CONT):
+            if self.msggot + datalenb <= len(self.msg):
+                # frame of a chunked message: straight into its buffer
+                self.bdata = self.bview = \
+                    self.msg[self.msggot:self.msggot+datalenb]
+                return
+            self._dropMessage('oversized')
+        if self.flags & (FRAME_TOTAL|FRAME_CONT):
+            self._skip(datalenb) # frame of a dropped message
+            return
+        if not self._fits(datalenb):
+            self._skip(datalenb)
+            return
+        if self.pool is not None and not self.flags & FRAME_COMPRESSED:
+            self.pooled = self.pool.get(self.btype, datalenb)
+            if self.pooled is not None:
+                self.bdata = self.bview = _byteView(self.pooled)[:datalenb]
+                return
+        try:
+            self.bdata = bytearray(datalenb)
+        except MemoryError:
+            print('WARNING: Dropping block of {} bytes in serpy2 (out of '
+                  'memory).'.format(datalenb))
+            self._skip(datalenb)
+            return
+        self.bview = memoryview(self.bdata)
+
+    def _skip(self, datalenb):
+        """Skip the payload of datalenb bytes of the frame, unread."""
+        self.bdata = self.bview = None
+        self.blen = datalenb
+        self.skipping = True
+
+    def _newStreamed(self, datalenb):
+        """Prepare the reception of a payload passed to self.stream."""
+        self.bdata = self.bview = None
+        self.blen = datalenb
+        if self.algo in _CHECKSUMCODES:
+            self.value = _CHECKSUMCODES[self.algo][2]
+
+    def _checkStreamed(self):
+        """
+        If the streamed payload is complete, verify its checksum and end
+        the stream if this was its last frame. Returns True if the payload
+        was complete.
+        """
+        if self.got < self.blen:
+            return False
+        self.frames += 1
+        if self.skipping:
+            self.skipping = False
+            self.btype = None
+            return True
+        tracer = self.tracer
+        if tracer is not None:
+            tracer(TRACE_FRAME, self.msgseq, perf_counter_ns())
+        if self.algo not in _CHECKSUMCODES:
+            print('WARNING: Unknown checksum algorithm on incoming data.')
+            ok = False
+        else:
+            ok = (self.value & 0xFFFFFFFF) == self.checksum
+        if ok and tracer is not None:
+            tracer(TRACE_CHECKSUM, self.msgseq, perf_counter_ns())
+        if not ok:
+            self.checksum_errors += 1
+            print('WARNING: Wrong checksum on incoming data.')
+            self.stream._finish(IOError("Wrong checksum on incoming data"))
+            self.stream = None
+        elif self.flags & (FRAME_TOTAL|FRAME_CONT):
+            self.msggot += self.blen
+            if not self.flags & FRAME_MORE:
+                if self.msggot == self.stream.size:
+                    self.stream._finish()
+                    self.stream = None
+                else:
+                    self._dropMessage('truncated')
+        else:
+            self.stream._finish()
+            self.stream = None
+        self.btype = None
+        return True
+
+    def abort(self, error):
+        """End the streams being received (if any) with the error."""
+        streams = [self.stream] + [m[3] for m in self.suspended.values()]
+        for stream in streams:
+            if stream is not None:
+                stream._finish(error)
+
+    def _checkBlock(self, blocks):
+        """
+        If the block being received is complete, verify its checksum and
+        append it to blocks. Returns True if the block was complete.
+        """
+        if self.got < len(self.bdata):
+            return False
+        self.frames += 1
+        tracer = self.tracer
+        if tracer is not None:
+            tracer(TRACE_FRAME, self.msgseq, perf_counter_ns())
+        if self.bview is not self.bdata:
+            self.bview.release()
+        if self.algo in _CHECKSUMCODES:
+            name, func, init = _CHECKSUMCODES[self.algo]
+            ok = (func(self.bdata, init) & 0xFFFFFFFF) == self.checksum
+        else:
+            ok = False
+            print('WARNING: Unknown checksum algorithm on incoming data.')
+        if ok and tracer is not None:
+            tracer(TRACE_CHECKSUM, self.msgseq, perf_counter_ns())
+        if ok and self.flags & (FRAME_TOTAL|FRAME_CONT):
+            if self.msg is not None:
+                self.msggot += len(self.bdata)
+                if not self.flags & FRAME_MORE:
+                    self._endMessage(blocks)
+            # else: frame of a dropped message, ignored
+        elif ok and self.flags & FRAME_COMPRESSED:
+            self._append(blocks, self.btype, 
+                         _Compressed(self.bdata, self.max_message))
+        elif ok:
+            self._append(blocks, self.btype, self.bdata)
+        else:
+            # Data error.
+            # For now, we print a warning and ignore, we do not
+            # put any information in the queue. Later, we could
+            # push a None or some ErrorType? which is then
+            # picked up in getData.
+            self.checksum_errors += 1
+            print('WARNING: Wrong checksum on incoming data.')
+            if self.pooled is not None:
+                self.pool.release(self.pooled)
+            if self.msg is not None and self.flags & (FRAME_TOTAL|FRAME_CONT):
+                self._dropMessage('corrupted')
+        self.btype = self.bdata = self.bview = self.pooled = None
+        return True
+
+    def _endMessage(self, blocks):
+        """The last frame of the chunked message has been received."""
+        if self.msggot == len(self.msg):
+            if self.flags & FRAME_COMPRESSED:
+                self._append(blocks, self.btype, 
+                             _Compressed(self.msg, self.max_message))
+            elif self.msgpooled is not None:
+                self._append(blocks, self.btype, self.msg)
+            else:
+                # the bytearray, like the payload of a single block
+                self._append(blocks, self.btype, self.msg.obj)
+            self.msg = self.msgpooled = None
+        else:
+            self._dropMessage('truncated')
+
+    def _resync(self):
+        """
+        The buffered data does not start with a header. This should
+        actually never happen. Skip to the next BLOCKIDCODE, if any.
+        """
+        #TODO Emit warning using warning.Warning
+        print('WARNING: Resynchronising block input stream in serpy2.')
+        self.resyncs += 1
+        if self.msg is not None or self.stream is not None:
+            self._dropMessage('corrupted')
+        for channel in list(self.suspended):
+            self._switchChannel(channel)
+            self._dropMessage('corrupted')
+        # BLOCKIDCODE and XBLOCKIDCODE only differ by their last byte
+        i = self.buf.find(BLOCKIDCODE[:4], self.start + 1, self.end)
+        if i < 0:
+            # keep the last bytes, which may be the start of a BLOCKIDCODE
+            i = max(self.start + 1, self.end - len(BLOCKIDCODE) + 1)
+        self.start = i
+
+
+
+class ByteBudget:
+    """
+    A budget of memory, in bytes, for the data held by one or more
+    BlockQueues (e.g. all the queues of the child Connections of a Server).
+    
+    A queue puts an item only once its size fits in the budget, and gives
+    the size back when the item leaves the queue. An item larger than the
+    whole budget is let through when nothing else is held, so that it 
+    cannot block forever.
+    """
+    def __init__(self, limit):
+        if limit <= 0:
+            raise ValueError("The budget must be positive")
+        self.limit = limit
+        self.used = 0
+        self.cond = threading.Condition()
+        self._onRelease = [] # callbacks to call once at the next release
+
+    def acquire(self, n, block=True, endtime=None, q=None):
+        """
+        Take n bytes of the budget, waiting for them until endtime 
+        (monotonic clock) if block is True, or until the BlockQueue q is 
+        stopped. Returns False if the bytes could not be taken.
+        """
+        with self.cond:
+            while self.used and self.used + n > self.limit:
+                if not block or (q is not None and q.put_stopped):
+                    return False
+                if endtime is None:
+                    self.cond.wait()
+                else:
+                    remaining = endtime - monotonic()
+                    if remaining <= 0.0:
+                        return False
+                    self.cond.wait(remaining)
+            self.used += n
+            return True
+
+    def charge(self, n):
+        """Take n bytes of the budget, even if they exceed it."""
+        with self.cond:
+            self.used += n
+
+    def release(self, n):
+        """Give back n bytes of the budget."""
+        with self.cond:
+            self.used -= n
+            self.cond.notify_all()
+            callbacks, self._onRelease = self._onRelease, []
+        for callback in callbacks:
+            callback()
+
+    def onRelease(self, callback):
+        """Call callback (once) the next time bytes are given back."""
+        with self.cond:
+            if callback not in self._onRelease:
+                self._onRelease.append(callback)
+
+    def wakeup(self):
+        """Have the threads waiting for the budget check their queue."""
+        with self.cond:
+            self.cond.notify_all()
+
+
+
+class BlockQueue(queue.Queue):
+    """
+    A queue.Queue whose blocked producers and/or consumers can all be
+    released at once with stop(), e.g. when a Connection is closed.
+    
+    Threads waiting on a BlockQueue therefore do not need to poll a stop
+    flag: they block until there is work, or until the queue is stopped.
+    Once stopped, a put that would block raises queue.Full and a get that
+    would block raises queue.Empty, until restart() is called.
+    
+    policy sets what put does when the queue is full (see QUEUE_POLICIES):
+     - 'block' (default): wait for room, as a queue.Queue
+     - 'latest': keep only the item put, dropping all the items queued
+       (whether the queue is full or not)
+     - 'drop-oldest': drop the oldest items to make room
+     - 'drop-newest': drop the item put
+    Except with 'block', put never blocks. The items dropped are counted 
+    in dropped, and passed to the optional on_drop callback.
+    
+    Besides maxsize items, the queue may be limited in bytes by the 
+    ByteBudgets budgets, the size of the items being given by sizeof. The
+    queue is then full as long as an item put does not fit in all of the
+    budgets. If wait_budget is False, the items are charged to the budgets
+    without waiting: for the later stages of a pipeline of queues, whose
+    items were admitted by the first stage already (waiting there could 
+    deadlock the pipeline).
+    """
+    def __init__(self, maxsize=0, policy='block', on_drop=None, budgets=(),
+                 sizeof=None, wait_budget=True):
+        _checkQueuePolicy(policy)
+        super().__init__(maxsize)
+        self.put_stopped = False
+        self.get_stopped = False
+        self.policy = policy
+        self.on_drop = on_drop
+        self.dropped = 0
+        self.budgets = [b for b in budgets if b is not None]
+        self.sizeof = sizeof
+        self.wait_budget = wait_budget
+
+    def stop(self, put=True, get=True):
+        """Release the blocked producers (put) and/or consumers (get)."""
+        with self.mutex:
+            self.put_stopped = self.put_stopped or put
+            self.get_stopped = self.get_stopped or get
+            self.not_full.notify_all()
+            self.not_empty.notify_all()
+        for b in self.budgets:
+            b.wakeup()
+
+    def restart(self):
+        """Have put and get block again."""
+        with self.mutex:
+            self.put_stopped = False
+            self.get_stopped = False
+
+    def clear(self):
+        """Remove all the items, and give their size back to the budgets."""
+        with self.mutex:
+            while self._qsize():
+                item = self._get()
+                if self.budgets:
+                    self._release(self._sizeOut(item))
+            self.not_full.notify_all()
+
+    def put(self, item, block=True, timeout=None):
+        if self.policy != 'block':
+            self._putDropping(item)
+            return
+        endtime = None
+        if timeout is not None:
+            if timeout < 0:
+                raise ValueError("'timeout' must be a non-negative number")
+            endtime = monotonic() + timeout
+        n = 0
+        if self.budgets:
+            n = self._sizeIn(item)
+            if not self._acquire(n, block, endtime):
+                raise queue.Full
+        with self.not_full:
+            if self.maxsize > 0:
+                while self._qsize() >= self.maxsize:
+                    if not block or self.put_stopped:
+                        self._release(n)
+                        raise queue.Full
+                    if endtime is None:
+                        self.not_full.wait()
+                    else:
+                        remaining = endtime - monotonic()
+                        if remaining <= 0.0:
+                            self._release(n)
+                            raise queue.Full
+                        self.not_full.wait(remaining)
+            self._put(item)
+            self.unfinished_tasks += 1
+            self.not_empty.notify()
+
+    def _putDropping(self, item):
+        """put for the policies dropping items (see BlockQueue)."""
+        dropped = []
+        with self.mutex:
+            if self.policy == 'latest':
+                limit = 1
+            elif self.policy == 'drop-oldest' and self.maxsize > 0:
+                limit = self.maxsize
+            else:
+                limit = None
+            if limit is not None:
+                while self._qsize() >= limit:
+                    if not self._dropOldest(dropped):
+                        break # nothing left that may be dropped
+            ok = not (self.policy == 'drop-newest' and self.maxsize > 0 and 
+                      self._qsize() >= self.maxsize)
+            if ok and self.budgets:
+                n = self._sizeIn(item)
+                while not self._acquire(n, False):
+                    if self.policy == 'drop-newest' or \
+                       not self._dropOldest(dropped):
+                        ok = False
+                        break
+            if ok:
+                self._put(item)
+                self.unfinished_tasks += 1
+                self.not_empty.notify()
+            else:
+                dropped.append(item)
+            self.dropped += len(dropped)
+        if self.on_drop is not None:
+            for old in dropped:
+                self.on_drop(old)
+
+    def _dropOldest(self, dropped):
+        """
+        Drop the oldest item that may be dropped into the list dropped.
+        Returns False if there is none. Called with the mutex held.
+        """
+        old = self._discard()
+        if old is None:
+            return False
+        if self.budgets:
+            self._release(self._sizeIn(old))
+        dropped.append(old)
+        return True
+
+    def _discard(self):
+        """
+        Remove and return the oldest item that may be dropped, or None.
+        Called with the mutex held.
+        """
+        return self._get() if self._qsize() else None
+
+    def _acquire(self, n, block, endtime=None):
+        """Take n bytes of all the budgets. Returns False on failure."""
+        if not self.wait_budget:
+            for b in self.budgets:
+                b.charge(n)
+            return True
+        for i, b in enumerate(self.budgets):
+            if not b.acquire(n, block, endtime, self):
+                for b in self.budgets[:i]:
+                    b.release(n)
+                return False
+        return True
+
+    def _release(self, n):
+        for b in self.budgets:
+            b.release(n)
+
+    def _sizeIn(self, item):
+        """The size of the item put, in bytes."""
+        return self.sizeof(item)
+
+    def _sizeOut(self, item):
+        """The size of the item got, in bytes."""
+        return self.sizeof(item)
+
+    def get(self, block=True, timeout=None):
+        with self.not_empty:
+            endtime = None
+            if timeout is not None:
+                if timeout < 0:
+                    raise ValueError("'timeout' must be a non-negative number")
+                endtime = monotonic() + timeout
+            while not self._qsize():
+                if not block or self.get_stopped:
+                    raise queue.Empty
+                if endtime is None:
+                    self.not_empty.wait()
+                else:
+                    remaining = endtime - monotonic()
+                    if remaining <= 0.0:
+                        raise queue.Empty
+                    self.not_empty.wait(remaining)
+            item = self._get()
+            if self.budgets:
+                self._release(self._sizeOut(item))
+            self.not_full.notify()
+            return item
+
+
+
+class ChannelQueue(BlockQueue):
+    """
+    The BlockQueue of the messages to send of a Connection, on several
+    logical channels (see Connection.sendData). The items put are 
+    (channel, frames, tag) tuples, frames being the list of the (bhead, 
+    bdata) frames of a message (see _encodeFrames), and tag None or the 
+    (sequence number, enqueue time) of the message (see 
+    Connection._queueBlock).
+    
+    get returns one frame at a time, as a ([frame], done, tag) tuple, done
+    being 1 for the last frame of a message, 0 otherwise. The frames of the 
+    channel of highest priority (see priorities) go first, so that a 
+    message on such a channel overtakes the large messages of the other
+    channels between two of their frames. Channels of equal priority take
+    turns. The messages of a channel are sent in order.
+    
+    maxsize is the number of messages queued, all channels together. With
+    a policy dropping messages (see BlockQueue), only messages none of 
+    whose frames has been taken yet are dropped.
+    """
+    def __init__(self, maxsize=0, priorities=None, policy='block',
+                 on_drop=None, budgets=(), wait_budget=True):
+        super().__init__(maxsize, policy, on_drop, budgets, 
+                         wait_budget=wait_budget)
+        # channel: priority (default 0, higher goes first)
+        self.priorities = {} if priorities is None else priorities
+
+    def _init(self, maxsize):
+        self.queues = {} # channel: deque of the (seq, deque of frames,
+                         # number of frames, tag) of the messages queued
+        self.count = 0
+        self.seq = 0 # number of messages put
+        self.turn = 0
+        self.served = {} # channel: turn at which it was last served
+
+    def _qsize(self):
+        return self.count
+
+    def _sizeIn(self, item):
+        return _framesSize(item[1])
+
+    def _sizeOut(self, item):
+        return _framesSize(item[0])
+
+    def _put(self, item):
+        channel, frames, tag = item
+        q = self.queues.get(channel)
+        if q is None:
+            q = self.queues[channel] = collections.deque()
+        q.append((self.seq, collections.deque(frames), len(frames), tag))
+        self.seq += 1
+        self.count += 1
+
+    def _get(self):
+        queues = self.queues
+        if len(queues) == 1:
+            channel = next(iter(queues))
+        else:
+            priorities, served = self.priorities, self.served
+            channel = max(queues, key=lambda c: (priorities.get(c, 0),
+                                                 -served.get(c, 0)))
+            self.turn += 1
+            served[channel] = self.turn
+        q = queues[channel]
+        seq, frames, nframes, tag = q[0]
+        frame = frames.popleft()
+        if frames:
+            return [frame], 0, tag
+        q.popleft()
+        self.count -= 1
+        if not q:
+            del queues[channel]
+        return [frame], 1, tag
+
+    def _discard(self):
+        # the oldest message not started yet, if any: the first or second
+        # message of a channel
+        best = None
+        for channel, q in self.queues.items():
+            for k in range(min(2, len(q))):
+                seq, frames, nframes, tag = q[k]
+                if len(frames) == nframes:
+                    if best is None or seq < best[0]:
+                        best = (seq, channel, k)
+                    break
+        if best is None:
+            return None
+        seq, channel, k = best
+        q = self.queues[channel]
+        item = (channel, list(q[k][1]), q[k][3])
+        del q[k]
+        self.count -= 1
+        if not q:
+            del self.queues[channel]
+        return item
+
+
+
+# Buckets of the histograms of Metrics: frame sizes (bytes, powers of 4
+# from 64 B to 64 MiB) and latencies (seconds, 100 us to 10 s)
+FRAMESIZEBUCKETS = tuple(1 << k for k in range(6, 27, 2))
+LATENCYBUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                  0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# The statistics of Connection.stats and Server.stats: name, kind and
+# description (see MetricsExporter). Counters never decrease, gauges are
+# the current state. Those in METRICSONLY are only measured by the
+# Connections created with metrics=True.
+STATS = (
+    ('bytes_in', 'counter', 'Bytes received'),
+    ('bytes_out', 'counter', 'Bytes handed to the socket'),
+    ('frames_in', 'counter', 'Frames (blocks) received'),
+    ('frames_out', 'counter', 'Frames (blocks) handed to the socket'),
+    ('messages_in', 'counter', 'Messages received'),
+    ('messages_queued', 'counter', 'Messages queued for sending'),
+    ('messages_sent', 'counter', 'Messages written or dropped'),
+    ('checksum_errors', 'counter', 'Blocks received with a wrong checksum'),
+    ('resyncs', 'counter', 'Resynchronisations of the input stream'),
+    ('reconnects', 'counter', 'Successful automatic reconnections'),
+    ('in_dropped', 'counter', 'Messages received dropped by in_policy'),
+    ('out_dropped', 'counter', 'Messages to send dropped by out_policy'),
+    ('broadcast_drops', 'counter', 'Connections skipped by broadcast'),
+    ('send_stall_seconds', 'counter', 'Time sendData waited for room'),
+    ('connections', 'gauge', 'Active connections'),
+    ('in_queued', 'gauge', 'Items received and not read yet'),
+    ('out_queued', 'gauge', 'Items waiting to be sent'),
+    ('in_budget_used', 'gauge', 'Bytes held of the in_bytes budgets'),
+    ('out_budget_used', 'gauge', 'Bytes held of the out_bytes budgets'),
+    ('budget_used', 'gauge', 'Bytes held of the memory_budget'),
+    ('frame_size_bytes', 'histogram', 'Size of the frames sent'),
+    ('send_latency_seconds', 'histogram', 
+     'Time from sendData to the last byte written'),
+)
+METRICSONLY = ('bytes_in', 'bytes_out', 'frames_out', 'messages_in',
+               'send_stall_seconds', 'frame_size_bytes', 
+               'send_latency_seconds')
+
+# The stages of the path of a message reported to the tracer of a 
+# Connection (see Connection), in order
+TRACE_SEND = 'send'             # sendData called
+TRACE_ENCODE = 'encode'         # frames encoded (checksum, compression)
+TRACE_HANDOFF = 'handoff'       # a frame handed to the socket
+TRACE_WRITTEN = 'written'       # the last frame written on the socket
+TRACE_FIRSTBYTE = 'first_byte'  # the header of the first frame received
+TRACE_FRAME = 'frame'           # the payload of a frame received
+TRACE_CHECKSUM = 'checksum'     # the checksum of a frame verified
+TRACE_DECODE = 'decode'         # the message decoded
+TRACE_GET = 'get'               # the message returned by getData
+TRACE_STAGES = (TRACE_SEND, TRACE_ENCODE, TRACE_HANDOFF, TRACE_WRITTEN,
+                TRACE_FIRSTBYTE, TRACE_FRAME, TRACE_CHECKSUM, TRACE_DECODE,
+                TRACE_GET)
+
+
+
+class Histogram:
+    """
+    Counts of values (sizes, durations...) in fixed buckets, as in 
+    Prometheus: counts[i] is the number of values <= bounds[i] (and
+    > bounds[i-1]), the last count the number of values above all bounds.
+    """
+    def __init__(self, bounds):
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def snapshot(self):
+        """The histogram as a dict (see Connection.stats)."""
+        return {'bounds': self.bounds, 'counts': self.counts[:],
+                'sum': self.sum, 'count': self.count}
+
+
+
+class Metrics:
+    """
+    The counters and histograms of a Connection created with metrics=True
+    (see Connection.stats). Each is updated by the thread doing the work 
+    it measures: the reading thread (in), the writing thread (out) or, 
+    under the lock of the Connection, the threads calling sendData.
+    """
+    def __init__(self):
+        self.bytes_in = 0
+        self.messages_in = 0
+        self.bytes_out = 0
+        self.frames_out = 0
+        self.send_stall = 0 # nanoseconds
+        self.frame_size = Histogram(FRAMESIZEBUCKETS)
+        self.send_latency = Histogram(LATENCYBUCKETS)
+
+    def snapshot(self):
+        return {'bytes_in': self.bytes_in, 'bytes_out': self.bytes_out,
+                'frames_out': self.frames_out, 
+                'messages_in': self.messages_in,
+                'send_stall_seconds': self.send_stall * 1e-9,
+                'frame_size_bytes': self.frame_size.snapshot(),
+                'send_latency_seconds': self.send_latency.snapshot()}
+
+
+def _addStats(total, stats, gauges=True):
+    """
+    Add the counters, histograms and, if gauges is True, the gauges of the
+    snapshot stats to those of total (see Server.stats).
+    """
+    for name, kind, doc in STATS:
+        if name not in stats or (kind == 'gauge' and not gauges):
+            continue
+        value = stats[name]
+        if kind != 'histogram':
+            total[name] = total.get(name, 0) + value
+        elif name not in total:
+            total[name] = dict(value, counts=value['counts'][:])
+        else:
+            h = total[name]
+            h['counts'] = [a + b for a, b in zip(h['counts'], 
+                                                 value['counts'])]
+            h['sum'] += value['sum']
+            h['count'] += value['count']
+    return total
+
+
+
+class Reactor:
+    """
+    A selector-driven I/O loop running in a single thread.
+    
+    The Reactor reads, assembles, decodes, encodes and writes the blocks
+    of all Connection objects (engine='selector') registered with it.
+    Work is only done when a socket is ready or when another thread wakes
+    the loop up, there is no polling.
+    
+    A Connection using the 'selector' engine creates its own private 
+    Reactor unless one is given to it.
+    
+    Usage:
+     - To create a Reactor and share it between Connections:
+        >>> r = Reactor().start()
+        >>> c1 = Connection(engine='selector', reactor=r).connect(adr, port)
+        >>> c2 = Connection(engine='selector', reactor=r).connect(adr, port)
+        ...
+        >>> r.close()
+    """
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._wake_r.setblocking(False)
+        self._wake_w.setblocking(False)
+        self.selector.register(self._wake_r, selectors.EVENT_READ, None)
+        self._calls = queue.SimpleQueue()
+        self._timers = [] # heap of (deadline, seq, func, args)
+        self._timerseq = 0
+        self.stop_sig = False
+        self.thread = None
+
+    def start(self):
+        """Start the reactor thread. Returns self."""
+        self.stop_sig = False
+        self.thread = threading.Thread(target=self._reactorThread,
+                                       daemon=True)
+        self.thread.start()
+        return self
+
+    def close(self):
+        """Stop the reactor thread and release its resources."""
+        self.stop_sig = True
+        self.wake()
+        if self.thread is not None and \
+           self.thread is not threading.current_thread():
+            self.thread.join()
+        self.selector.close()
+        self._wake_r.close()
+        self._wake_w.close()
+
+    def inReactorThread(self):
+        """Returns True if called from the reactor thread."""
+        return self.thread is threading.current_thread()
+
+    def wake(self):
+        """Interrupt the select() call of the reactor thread."""
+        try:
+            self._wake_w.send(b'\x00')
+        except (BlockingIOError, OSError):
+            # wake-up already pending, or reactor closed
+            pass
+
+    def call(self, func, *args):
+        """
+        Have func(*args) executed by the reactor thread as soon as possible.
+        """
+        self._calls.put((func, args))
+        self.wake()
+
+    def callLater(self, delay, func, *args):
+        """
+        Have func(*args) executed by the reactor thread after delay 
+        seconds. Must be called from the reactor thread.
+        """
+        self._timerseq += 1
+        heapq.heappush(self._timers, (monotonic() + delay, self._timerseq,
+                                      func, args))
+
+    def callWait(self, func, *args):
+        """
+        Have func(*args) executed by the reactor thread and wait for it to
+        be done.
+        """
+        if self.inReactorThread() or self.thread is None \
+           or not self.thread.is_alive():
+            func(*args)
+            return
+        done = threading.Event()
+        def wrapper():
+            try:
+                func(*args)
+            finally:
+                done.set()
+        self.call(wrapper)
+        done.wait()
+
+    def register(self, c):
+        """Start serving the Connection c."""
+        self.call(self._register, c)
+
+    def unregister(self, c):
+        """Stop serving the Connection c (waits until done)."""
+        self.callWait(self._unregister, c)
+
+    def _register(self, c):
+        if c.stop_sig:
+            return
+        self.selector.register(c.conn, c._selectorEvents(), c)
+
+    def _unregister(self, c):
+        try:
+            self.selector.unregister(c.conn)
+        except (KeyError, ValueError):
+            pass # not registered anymore (e.g. broken connection)
+
+    def modify(self, c):
+        """Update the events the reactor waits for on behalf of c."""
+        try:
+            self.selector.modify(c.conn, c._selectorEvents(), c)
+        except (KeyError, ValueError):
+            pass
+
+    def _reactorThread(self):
+        """
+        The single thread of the reactor. Blocks in select() until a 
+        socket is ready or until woken up.
+        """
+        while not self.stop_sig:
+            timeout = None
+            if self._timers:
+                timeout = max(0, self._timers[0][0] - monotonic())
+            events = self.selector.select(timeout)
+            for key, mask in events:
+                if key.data is None:
+                    # wake-up socket: drain it
+                    try:
+                        while self._wake_r.recv(4096):
+                            pass
+                    except (BlockingIOError, OSError):
+                        pass
+                    continue
+                c = key.data
+                try:
+                    if mask & selectors.EVENT_READ:
+                        c._onReadable()
+                    if mask & selectors.EVENT_WRITE:
+                        c._onWritable()
+                except Exception:
+                    self._failed(c)
+            self._runCalls()
+            self._runTimers()
+        # nobody should remain waiting on a call after the reactor stopped
+        self._runCalls()
+
+    def _failed(self, c):
+        """
+        A callback of c raised an exception: report it and drop c only, 
+        so that the reactor keeps serving the other Connections.
+        """
+        print('WARNING: Error in the serpy2 reactor, dropping connection:')
+        traceback.print_exc()
+        try:
+            c._onBroken()
+        except Exception:
+            traceback.print_exc()
+
+    def _run(self, func, args):
+        """Run a timer or a call, reporting its exception (if any)."""
+        try:
+            func(*args)
+        except Exception:
+            print('WARNING: Error in a serpy2 reactor call:')
+            traceback.print_exc()
+
+    def _runTimers(self):
+        now = monotonic()
+        while self._timers and self._timers[0][0] <= now:
+            deadline, seq, func, args = heapq.heappop(self._timers)
+            self._run(func, args)
+
+    def _runCalls(self):
+        while True:
+            try:
+                func, args = self._calls.get_nowait()
+            except queue.Empty:
+                break
+            self._run(func, args)
+
 
 
 
@@ -86,18 +2690,221 @@ class Connection:
     
      - To create a Connection and connect it:
         >>> c = Connection(auto_restart).connect(adr, port)
+    
+    ------
+    Engines:
+     - 'threads' (default): four threads per Connection, passing the 
+       blocks along through queues.
+     - 'selector': a single selector-driven Reactor thread reads, 
+       assembles, decodes and writes the blocks in place. sendData
+       encodes the block in the calling thread. Several Connections may
+       share one Reactor (optional reactor argument).
+    
+    ------
+    Checksums:
+     The integrity of each block sent is protected by the checksum
+     algorithm selected with the checksum argument: 'sum' (default,
+     original serpy2 protocol), 'crc32', 'adler32', or 'none' (for trusted
+     loopback links), see CHECKSUMS and registerChecksum. The algorithm is
+     recorded in each block, so both ends may use different algorithms.
+    
+    ------
+    Receive buffers:
+     With the optional pool argument (a BufferPool), raw data and ndarrays
+     are received into preallocated buffers instead of newly allocated 
+     ones (see BufferPool and getDataInto).
+    
+    ------
+    Large data:
+     Data larger than chunksize bytes (default CHUNKSIZE) is sent as a
+     chunked message, made of frames of at most chunksize bytes. There is
+     then no limit to the size of the data, and the receiving end gathers
+     the frames straight into one buffer (raw data is then copied into 
+     bytes, like smaller data, unless the buffer comes from the pool).
+     
+     Raw data of at least stream_size bytes (default None: never) is
+     delivered while it is being received, as a BlockStream (see
+     getStream), so that it can be processed as it arrives.
+     
+     Data received in memory is limited to max_message bytes (default 
+     MAXMESSAGE, None: no limit): larger data is dropped with a warning,
+     instead of allocating whatever size a (corrupt) header announces, 
+     and so is compressed data which would decompress to more.
+    
+    ------
+    Channels:
+     sendData and getData take an optional logical channel (0 to 255, 
+     default 0), each channel having its own receive queue. The frames of
+     large data are interleaved with the data of the other channels, the
+     channels of higher priority (see setPriority) going first: with a 
+     small chunksize (e.g. 256 KiB), a command sent on a high priority
+     channel overtakes the large data being sent within a frame.
+    
+    ------
+    Queue policies:
+     in_policy and out_policy set what happens when the queues of the 
+     data received (in_q) or to send (out_q) are full: 'block' (default,
+     the sender waits, the reception stalls), 'latest' (only the most 
+     recent data is kept, e.g. for live previews), 'drop-oldest' or 
+     'drop-newest'. The data dropped is counted in the dropped attribute
+     of the queues (see BlockQueue): in_q (and the queues of the other
+     channels), out_q, and out_block_q (engine 'threads').
+    
+    ------
+    Memory:
+     in_bytes and out_bytes limit the memory held by the data received 
+     and not read yet, and by the data waiting to be sent, in bytes 
+     (default None: only QUEUELEN items per queue). Once out_bytes are
+     used, sendData blocks (or raises queue.Full on timeout); once 
+     in_bytes are used, the Connection stops reading its socket. The
+     optional budget (a ByteBudget) is shared with other Connections, 
+     e.g. those of a Server.
+    
+    ------
+    Metrics:
+     stats() returns a snapshot of the counters and gauges of the 
+     Connection (see STATS): queue depths, frames received, checksum 
+     errors, resyncs, reconnections, data dropped... With metrics=True,
+     the bytes and frames in and out, the time sendData waits for room,
+     and histograms of the size of the frames sent and of the latency 
+     from sendData to the socket are measured too (see Metrics). Without
+     it, sending and receiving are not instrumented at all. See 
+     MetricsExporter to serve them to Prometheus.
+    
+    ------
+    Tracing:
+     The optional tracer is called as tracer(connection, stage, seq, t) 
+     at each stage of the path of every message (see TRACE_STAGES), t 
+     being a time.perf_counter_ns() timestamp and seq the sequence number
+     of the message. Sending: TRACE_SEND, TRACE_ENCODE, TRACE_HANDOFF 
+     (for each frame) and TRACE_WRITTEN. Receiving: TRACE_FIRSTBYTE, 
+     TRACE_FRAME and TRACE_CHECKSUM (for each frame), TRACE_DECODE and
+     TRACE_GET. The frames of the messages sent with a tracer carry 
+     their sequence number (FRAME_SEQ), so that the receiver reports the
+     number given by the sender, on every channel. The messages received
+     from a peer without tracer are numbered in the order they start 
+     arriving. The tracer is called from the threads doing the work, so
+     it must be quick.
+    
+    ------
+    Latency and throughput:
+     - nodelay: if True (False), disable (enable) Nagle's algorithm
+       (TCP_NODELAY) to send small blocks without delay. Default None: 
+       leave the system default.
+     - cork: if True, the socket is corked (TCP_CORK, Linux only) while 
+       blocks are being written and uncorked when there is nothing more 
+       to write, so that the kernel sends full packets.
+     - coalesce_bytes, coalesce_delay: if coalesce_bytes is not 0, the 
+       blocks queued by sendData are gathered and written together, up to 
+       coalesce_bytes bytes per write. When fewer bytes are queued, the 
+       write waits at most coalesce_delay seconds (default 0: no wait) for
+       more blocks.
+     Latency-optimised link: nodelay=True. Throughput-optimised link: 
+     coalesce_bytes=65536, coalesce_delay=0.001 and/or cork=True.
+    
+    ------
+    Compression:
+     With compress set to the name of a codec ('zlib', 'bz2', 'lzma', see
+     CODECS and registerCodec), the data of the types listed in 
+     compress_types (block type codes, default: str, raw data and 
+     ndarrays) of at least compress_min bytes is sent compressed, unless 
+     it does not compress. Compressed data is decompressed on reception,
+     whatever the compress option of the receiving end.
+    
+    ------
+    Encoding:
+     With compact=True, int and float are sent in compact binary 
+     encodings (varint, IEEE-754 binary64) instead of the original serpy2
+     ones, which older peers cannot decode (see sendData).
     """
-    def __init__(self, sock=None, auto_restart=False):
+    def __init__(self, sock=None, auto_restart=False, engine='threads',
+                 reactor=None, checksum='sum', pool=None, chunksize=CHUNKSIZE,
+                 stream_size=None, nodelay=None, cork=False, coalesce_bytes=0,
+                 coalesce_delay=0.0, compress=None, compress_min=COMPRESSMIN,
+                 compress_types=COMPRESSTYPES, compact=False,
+                 in_policy='block', out_policy='block', in_bytes=None,
+                 out_bytes=None, budget=None, metrics=False, tracer=None,
+                 max_message=MAXMESSAGE):
+        if engine not in ENGINES:
+            raise ValueError("Unknown engine '{}'".format(engine))
+        _checkChecksumName(checksum)
+        _checkCodecName(compress)
+        _checkChunkSize(chunksize)
         self.conn = sock
+        self.checksum = checksum
+        self.pool = pool
+        self.chunksize = chunksize
+        self.stream_size = stream_size
+        self.max_message = max_message
+        self.nodelay = nodelay
+        self.cork = cork
+        self.coalesce_bytes = coalesce_bytes
+        self.coalesce_delay = coalesce_delay
+        self.compress = compress
+        self.compress_min = compress_min
+        self.compress_types = compress_types
+        self.compact = compact
+        self._corked = False
         self.auto_restart = auto_restart
+        self.engine = engine
+        self.reactor = reactor
+        self._own_reactor = False
         self.connected = sock != None
         self.adr = 0
-        self.in_q = queue.Queue(QUEUELEN)
-        self.out_q = queue.Queue(QUEUELEN)
-        self.block_q = queue.Queue(QUEUELEN)
-        self.out_block_q = queue.Queue(QUEUELEN)
+        self.in_policy = in_policy
+        self.out_policy = out_policy
+        # memory limits of the data received and to send (see ByteBudget)
+        self.in_budget = ByteBudget(in_bytes) if in_bytes else None
+        self.out_budget = ByteBudget(out_bytes) if out_bytes else None
+        self.budget = budget
+        in_budgets = (self.in_budget, budget)
+        out_budgets = (self.out_budget, budget)
+        self.priorities = {} # channel: priority (see setPriority)
+        # engine 'threads': the bytes are waited for when entering the
+        # first queue of the pipelines (block_q and out_q) only
+        threads = engine != 'selector'
+        self.in_q = BlockQueue(QUEUELEN, in_policy, self._receivedDropped,
+                               in_budgets, _dataSize, not threads)
+        self.channel_qs = {} # channel: in_q of the channels other than 0
+        if engine == 'selector':
+            self.out_q = ChannelQueue(QUEUELEN, self.priorities, out_policy,
+                                      self._queuedDropped, out_budgets)
+        else:
+            self.out_q = BlockQueue(QUEUELEN, out_policy, 
+                                    self._queuedDropped, out_budgets,
+                                    _queuedSize)
+        self.block_q = BlockQueue(QUEUELEN, budgets=in_budgets,
+                                  sizeof=lambda block: _payloadSize(block[1]))
+        self.out_block_q = ChannelQueue(QUEUELEN, self.priorities, out_policy,
+                                        self._queuedDropped, out_budgets,
+                                        not threads)
         self.stop_sig = False
         self.ackEvent = threading.Event() 
+        self.threadSet = set()
+        self._server = None # the Server which accepted this Connection
+        self._parser = None # BlockParser of the incoming data
+        self.rpc_client = None     # RPCClient and RPCDispatcher attached
+        self.rpc_dispatcher = None # to this Connection, if any
+        self.metrics = Metrics() if metrics else None
+        self.tracer = tracer
+        self.reconnects = 0
+        # count of the blocks queued by sendData and written out
+        self._sentCond = threading.Condition()
+        self._nqueued = 0
+        self._nsent = 0
+        # 'selector' engine state
+        self._rx_backlog = []
+        self._rx_paused = False
+        self._txbufs = []
+        self._txcount = 0 # number of blocks in _txbufs
+        self._txtags = [] # tags of the messages completed by _txbufs
+        self._writing = False
+        self._batch = [] # blocks gathered for the next write
+        self._batchsize = 0
+        self._batchcount = 0
+        self._batchtags = []
+        self._flushNow = False
+        self._holdTimer = False
     
     def __iter__(self):
         """
@@ -106,7 +2913,7 @@ class Connection:
         """
         try:
             while True:
-                yield self.in_q.get(timeout=STIMEOUT)
+                yield self.getData(timeout=STIMEOUT)
         except queue.Empty:
             pass
 
@@ -130,6 +2937,16 @@ class Connection:
     def start(self):
         """Start the connection (start the threads)"""
         self.stop_sig = False
+        for q in (self.in_q, self.out_q, self.block_q, self.out_block_q,
+                  *self.channel_qs.values()):
+            q.restart()
+        with self._sentCond:
+            # blocks discarded by a previous close will never be sent
+            self._nsent = self._nqueued - self.out_q.qsize()
+        self._setSocketOptions()
+        if self.engine == 'selector':
+            self._startSelector()
+            return
         threadSet = set()
         threadSet.add(threading.Thread(target=self._inThread))
         threadSet.add(threading.Thread(target=self._outThread))
@@ -142,16 +2959,107 @@ class Connection:
     def close(self):
         """Stop the threads and closes the connection (socket)
         
-        #TODO: check if this requires the Connection to do further cleaning up:
-        stop threads etc.
+        Returns right away: the threads blocked on a queue or on the socket
+        are released instead of being waited for.
         """
         self.stop_sig = True
         self.ackEvent.set() #setting events to free the threads
+        # release the threads blocked on the queues. Those waiting for 
+        # received data in getData are left alone (they may time out)
+        for q in (self.out_q, self.block_q, self.out_block_q):
+            q.stop()
+        for q in (self.in_q, *self.channel_qs.values()):
+            q.stop(get=False)
+        with self._sentCond:
+            self._sentCond.notify_all() # release waitSent
+        self._abortStream()
+        if self.rpc_client is not None:
+            self.rpc_client._connectionLost()
+        if self.engine == 'selector':
+            self._closeSelector()
+        else:
+            # release the threads blocked on the socket (recv, sendall)
+            try:
+                self.conn.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass # already disconnected
         for t in self.threadSet:
+            if t is threading.current_thread():
+                continue
             t.join()
         self.conn.close()
         self.connected = False
 
+    def _setSocketOptions(self):
+        """Apply the nodelay option to the socket."""
+        self._corked = False
+        if self.nodelay is not None:
+            try:
+                self.conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY,
+                                     int(self.nodelay))
+            except OSError:
+                pass # not a TCP socket
+
+    def _setCork(self, on):
+        """Cork (on=True) or uncork the socket, if the cork option is set."""
+        if not self.cork or not HAVE_CORK or on == self._corked:
+            return
+        try:
+            self.conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, int(on))
+        except OSError:
+            pass
+        self._corked = on
+
+    def _abortStream(self):
+        """Release the readers of the BlockStream being received, if any."""
+        if self._parser is not None:
+            self._parser.abort(ConnectionError("Connection closed"))
+
+    def _newParser(self):
+        """
+        Make a new BlockParser for the incoming data, carrying on the counts
+        of the previous one (see stats). Returns it.
+        """
+        tracer = None
+        if self.tracer is not None:
+            tracer = functools.partial(self.tracer, self)
+        parser = BlockParser(pool=self.pool, stream_size=self.stream_size,
+                             tracer=tracer, max_message=self.max_message)
+        old = self._parser
+        if old is not None:
+            parser.frames = old.frames
+            parser.checksum_errors = old.checksum_errors
+            parser.resyncs = old.resyncs
+        self._parser = parser
+        return parser
+
+    def _startSelector(self):
+        """Start the connection on a Reactor (engine='selector')"""
+        self._newParser()
+        self._rx_backlog = []
+        self._rx_paused = False
+        self._txbufs = []
+        self._txcount = 0
+        self._txtags = []
+        self._batch = []
+        self._batchtags = []
+        self._batchsize = self._batchcount = 0
+        self._flushNow = self._holdTimer = False
+        self._writing = not self.out_q.empty()
+        if self.reactor is None or self._own_reactor:
+            self.reactor = Reactor().start()
+            self._own_reactor = True
+        self.conn.setblocking(False)
+        self.reactor.register(self)
+
+    def _closeSelector(self):
+        """Take the connection off its Reactor (engine='selector')"""
+        if self.reactor is None:
+            return
+        self.reactor.unregister(self)
+        if self._own_reactor:
+            self.reactor.close()
+
     def _brokenConnection(self):
         """ 
         This method will start the _brokenConnHandler thread so that
@@ -161,157 +3069,389 @@ class Connection:
             #warnings.warn("Connection to {} broken !".format(self.adr))
         self.connected = False
         self.stop_sig = True
+        self._abortStream()
+        if self.rpc_client is not None:
+            self.rpc_client._connectionLost()
+        if self._server is not None:
+            self._server._forget(self)
         threading.Thread(target=self._brokenConnHandler).start()
 
-    def _brokenConnHandler(self):
+    def _brokenConnHandler(self):
+        """
+        Handles broken connections and tries to restart it if auto
+        restart is enabled.
+        """
+        if self.auto_restart :
+            warnings.warn("Attempting connection restart")
+            for i in range(1000):
+                try:
+                    self.close()
+                    self.connect(*self.adr)
+                except:
+                    sleep(0.5) #TODO replace this magic number with a defined constant
+                else:
+                    self.reconnects += 1
+                    break
+            #warnings.warn("finished")
+        else :
+            #warnings.warn("Closing connection")
+            self.close()
+
+
+    def _selectorEvents(self):
+        """The selector events the Reactor should wait for."""
+        events = 0
+        if not self._rx_paused:
+            events |= selectors.EVENT_READ
+        if self._writing:
+            events |= selectors.EVENT_WRITE
+        return events
+
+    def _onBroken(self):
+        """Called in the Reactor thread when the socket fails."""
+        self.reactor._unregister(self)
+        if not self.stop_sig:
+            self._brokenConnection()
+
+    def _onReadable(self):
+        """
+        Called in the Reactor thread when the socket has data. Reads it,
+        assembles all the blocks completed and decodes them into the in_q.
+        """
+        if self.stop_sig or self._rx_paused:
+            return
+        stream = self._parser.stream
+        if stream is not None and stream._full():
+            # pause until the BlockStream being received is read
+            stream._onRoom = lambda: self.reactor.call(self._resumeReading)
+            if stream._full():
+                self._rx_paused = True
+                self.reactor.modify(self)
+                return
+        try:
+            n = self.conn.recv_into(self._parser.getBuffer())
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            n = 0
+        if not n:
+            self._onBroken()
+            return
+        blocks = self._parser.bufferUpdated(n)
+        if self.metrics is not None:
+            self.metrics.bytes_in += n
+            self.metrics.messages_in += len(blocks)
+        seqs = itertools.repeat(None)
+        if self._parser.tracer is not None:
+            seqs = self._parser.blockseqs
+        for (btype, bdata, channel), seq in zip(blocks, seqs):
+            try:
+                data = _decodeData(btype, bdata)
+            except (TypeError, ValueError) as err:
+                print('WARNING: {}'.format(err))
+                continue
+            except Exception as err:
+                # an unexpected failure only drops this block
+                print('WARNING: Cannot decode received data ({!r})'.format(
+                      err))
+                continue
+            if seq is not None:
+                data = self._traceDecoded(data, seq)
+            if type(data) is _RPCMessage:
+                self._routeRPC(data)
+            else:
+                self._deliver(data, channel)
+
+    def _inQueue(self, channel):
+        """The in_q of the channel channel."""
+        if not channel:
+            return self.in_q
+        q = self.channel_qs.get(channel)
+        if q is None:
+            q = self.channel_qs.setdefault(channel, BlockQueue(QUEUELEN,
+                    self.in_policy, self._receivedDropped, self.in_q.budgets,
+                    _dataSize, self.in_q.wait_budget))
+            if self.stop_sig:
+                q.stop(get=False)
+        return q
+
+    def _traceDecoded(self, data, seq):
+        """
+        Trace the message seq as decoded into data. Returns data, to be
+        queued with its sequence number (unless it is an RPC message).
+        """
+        self.tracer(self, TRACE_DECODE, seq, perf_counter_ns())
+        if type(data) is _RPCMessage:
+            return data
+        return _Traced(data, seq)
+
+    def _receivedDropped(self, data):
+        """Data received was dropped from an in_q (see in_policy)."""
+        if type(data) is _Traced:
+            data = data.data
+        if type(data) is BlockStream:
+            data.close()
+        elif self.pool is not None:
+            self.pool.release(data)
+
+    def _queuedDropped(self, item):
+        """A message was dropped from an output queue (see out_policy)."""
+        self._blockSent()
+
+    def _routeRPC(self, msg):
+        """
+        Hand a received RPC message over to the RPCDispatcher (requests)
+        or the RPCClient (replies) of this Connection, instead of the in_q.
+        Runs in the receiving thread, so it must never block.
+        """
+        if msg.kind == RPC_REQUEST:
+            handler = self.rpc_dispatcher
+        else:
+            handler = self.rpc_client
+        if handler is None:
+            print('WARNING: RPC message received, but no {} is attached to '
+                  'the Connection'.format('RPCDispatcher' 
+                      if msg.kind == RPC_REQUEST else 'RPCClient'))
+            return
+        handler._onMessage(self, msg)
+
+    def _deliver(self, data, channel=0):
+        """
+        Put decoded data into the in_q of its channel from the Reactor 
+        thread. The Reactor never blocks: if the in_q is full, reading from
+        this connection is paused until getData makes room.
+        """
+        if not self._rx_backlog:
+            try:
+                self._inQueue(channel).put_nowait(data)
+                return
+            except queue.Full:
+                pass
+        self._rx_backlog.append((channel, data))
+        if not self._rx_paused:
+            self._rx_paused = True
+            self._waitBudget()
+            self.reactor.modify(self)
+
+    def _resumeReading(self):
+        """
+        Called in the Reactor thread when the in_q, or the BlockStream
+        being received, has room again.
+        """
+        while self._rx_backlog:
+            channel, data = self._rx_backlog[0]
+            try:
+                self._inQueue(channel).put_nowait(data)
+            except queue.Full:
+                self._waitBudget()
+                return
+            del self._rx_backlog[0]
+        if self._rx_paused:
+            self._rx_paused = False
+            self.reactor.modify(self)
+
+    def _waitBudget(self):
+        """
+        Try to resume reading once the receive budgets are given back some 
+        bytes, by this Connection or by others sharing them.
+        """
+        for b in self.in_q.budgets:
+            b.onRelease(self._budgetReleased)
+
+    def _budgetReleased(self):
+        if self.reactor is not None and not self.stop_sig:
+            self.reactor.call(self._resumeReading)
+
+    def _clearOutput(self):
+        """Drop the data waiting to be sent, freeing its budget."""
+        for q in (self.out_q, self.out_block_q):
+            q.clear()
+
+    def _onWritable(self):
+        """
+        Called in the Reactor thread when the socket can take data. Writes
+        as many queued blocks as the socket accepts.
+        """
+        while not self.stop_sig:
+            if not self._txbufs:
+                if not self._fillBatch():
+                    return
+                continue
+            try:
+                self._txbufs = _sendBuffers(self.conn, self._txbufs)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                self._onBroken()
+                return
+            if self._txbufs:
+                return # socket buffer full, wait for next EVENT_WRITE
+            self._blockSent(self._txcount)
+            if self._txtags:
+                self._tagsSent(self._txtags)
+                self._txtags = []
+
+    def _fillBatch(self):
         """
-        Handles broken connections and tries to restart it if auto
-        restart is enabled.
+        Gather queued blocks into _txbufs (see coalesce_bytes). Returns
+        False if there is nothing to write for now.
         """
-        if self.auto_restart :
-            warnings.warn("Attempting connection restart")
-            for i in range(1000):
-                try:
-                    self.close()
-                    self.connect(*self.adr)
-                except:
-                    sleep(0.5) #TODO replace this magic number with a defined constant
-                else:
+        while not self._batch or self._batchsize < self.coalesce_bytes:
+            try:
+                frames, done, tag = self.out_q.get_nowait()
+            except queue.Empty:
+                if self._batch and (self._flushNow or 
+                                    not self.coalesce_delay):
                     break
-            #warnings.warn("finished")
-        else :
-            #warnings.warn("Closing connection")
-            self.close()
+                # See sendData for why the flag is cleared before
+                # checking the queue once more.
+                self._writing = False
+                if self.out_q.empty():
+                    if not self._batch:
+                        self._setCork(False)
+                    elif not self._holdTimer:
+                        # hold the blocks for at most coalesce_delay
+                        self._holdTimer = True
+                        self.reactor.callLater(self.coalesce_delay,
+                                               self._flushBatch)
+                    self.reactor.modify(self)
+                    return False
+                self._writing = True
+                continue
+            views = _frameBuffers(frames)
+            if tag is not None:
+                self._framesTaken(views, done, tag, self._batchtags)
+            self._batch += views
+            self._batchsize += sum(len(v) for v in views)
+            self._batchcount += done
+        if self.coalesce_bytes:
+            self._txbufs = _joinSmall(self._batch)
+        else:
+            self._txbufs = self._batch
+        self._txcount = self._batchcount
+        self._txtags, self._batchtags = self._batchtags, []
+        self._batch = []
+        self._batchsize = self._batchcount = 0
+        self._flushNow = False
+        self._setCork(True)
+        return True
+
+    def _flushBatch(self):
+        """Reactor timer: write the blocks held for coalescing."""
+        self._holdTimer = False
+        if self._batch and not self.stop_sig:
+            self._flushNow = True
+            self._writing = True
+            self.reactor.modify(self)
 
+    def _wantWrite(self):
+        """Called in the Reactor thread when blocks have been queued."""
+        self.reactor.modify(self)
         
     def _outThread(self):
         """
         Get blocks when available and sends them
         """
         while not self.stop_sig:
-            readable, writable, errored = select.select([], (self.conn,), [], STIMEOUT)
-            assert len(writable) < 2,\
-                "Unexpectedly have two connections to write to. I don't understand!"
-            for s in writable:
-                if not self.out_block_q.empty():
-                    s.sendall(self.out_block_q.get())
-                else :
-                    sleep(STIMEOUT)
+            try:
+                # blocks until there is work
+                frames, count, tag = self.out_block_q.get()
+            except queue.Empty:
+                break # out_block_q stopped: Connection closed
+            views = _frameBuffers(frames)
+            tags = []
+            if tag is not None:
+                self._framesTaken(views, count, tag, tags)
+            if self.coalesce_bytes:
+                views, count = self._gatherBlocks(views, count, tags)
+            try:
+                self._setCork(True)
+                _sendAll(self.conn, views)
+                if self.out_block_q.empty():
+                    self._setCork(False)
+            except OSError:
+                if not self.stop_sig:
+                    self._brokenConnection()
+                break
+            self._blockSent(count)
+            if tags:
+                self._tagsSent(tags)
+
+    def _gatherBlocks(self, views, count, tags):
+        """
+        Add the blocks queued in the out_block_q to the buffers views (of
+        count blocks), up to coalesce_bytes bytes, waiting at most 
+        coalesce_delay for them. Returns the buffers and the number of 
+        blocks. The tags of the messages completed are added to tags.
+        """
+        size = sum(len(v) for v in views)
+        deadline = monotonic() + self.coalesce_delay
+        while size < self.coalesce_bytes:
+            wait = deadline - monotonic()
+            try:
+                if wait > 0:
+                    frames, done, tag = self.out_block_q.get(timeout=wait)
+                else:
+                    frames, done, tag = self.out_block_q.get_nowait()
+            except queue.Empty:
+                break
+            more = _frameBuffers(frames)
+            if tag is not None:
+                self._framesTaken(more, done, tag, tags)
+            views += more
+            size += sum(len(v) for v in more)
+            count += done
+        return _joinSmall(views), count
                 
+    def _recvInto(self, view):
+        """
+        Receive data from the socket into the writable buffer view.
+        Returns the number of bytes received, 0 if the connection is broken
+        or closed.
+        """
+        try:
+            n = self.conn.recv_into(view)
+        except OSError:
+            n = 0
+        if not n and not self.stop_sig:
+            self._brokenConnection()
+        return n
+
     def _inThread(self):
         """
         This thread listens on the connection and retrieves any data that
         is sent on the socket. Then it assembles the data into 
-        intelligible messages named blocks.
+        intelligible messages named blocks, using a BlockParser: data is
+        received straight into the buffers of the parser, and all the
+        blocks completed by a recv are extracted before waiting on the
+        socket again.
         
         Blocks are then put into the block_q to be processed by the 
         _listeningCenterThread.
         """
-        data = bytes()
-        bdata = bytes()
-        instate = 1 
+        parser = self._newParser()
+        metrics = self.metrics
         while not self.stop_sig:
-            readable, writable, errored = select.select((self.conn,), [], (self.conn,), STIMEOUT)
-
-            assert len(readable) < 2,\
-                "Unexpectedly have several connections to read from. I don't understand! It will lead to problems reconstructing data blocks using present code."
-
-            if errored :
-                self._brokenConnection()
+            stream = parser.stream
+            if stream is not None and stream._full():
+                # wait for the BlockStream being received to be read
+                stream._waitRoom()
                 continue
-            
-            for s in readable:
-                if not self.block_q.full():
-                    try:
-                        chunk = self.conn.recv(4096)
-                    except ConnectionResetError:
-                        self._brokenConnection()
-                    else:
-                        if chunk:
-                            data += chunk
-                        else :
-                            self._brokenConnection()
-                            
-            # A two-state machine handles the assembly of the blocks
-            # from the incoming chunks of data.
-            if instate == 1:
-                # waiting for a fresh block
-                # received data is expected to start with
-                # BLOCKIDCODE
-                if (len(data)>=HEADLEN) and data.startswith(BLOCKIDCODE):
-                    # decode header                    
-                    bheader = data[0:HEADLEN]
-                    btype = bheader[5:6] #this gives a bytes object
-                    checksum = int.from_bytes(bheader[6:10],
-                                              'little', signed=False)
-                    datalenb = int.from_bytes(bheader[10:14],
-                                              'little', signed=False)
-                    # prepare for state 2: receive block
-                    bdata = bytes()
-                    data = data[HEADLEN:]
-                    instate = 2 # switch state
-                else:
-                    if (len(data) >= HEADLEN):
-                        # In case the received data is not a header:
-                        # Reset input buffer, and wait for new data.
-                        #
-                        # This should actually never happen. If it happens,
-                        # we might need to do some kind of reset on the
-                        # connection, and the reception queues
-                        # 
-                        #TODO Emit warning using warning.Warning
-                        print('WARNING: Resetting chunk input buffer on Connection._inThread in serpy2.')
-                        data = bytes() 
-            
-            # state machine can switch from state 1 to state 2 within same
-            # cycle
-            # since we have only two states, we can do this
-            if instate == 2:
-                # In the process of receiving a block...
-                bdata_remaining = datalenb - len(bdata)
-                if (len(data) > bdata_remaining):
-                    # more incoming data than needed, split data
-                    # just take what is needed
-                    bdata += data[0:bdata_remaining] 
-
-                    # Consistency check.
-                    if len(bdata)!=datalenb:
-                        print('len bdata = ',len(bdata))
-                        print('bdata_remaining = ',bdata_remaining)
-                        print('len data =',len(data))
-                        print('datalenb =',datalenb)
-                    assert len(bdata)==datalenb, 'Programmer Error. Incorrect length calculations.'
-
-                    # and put the rest in updated databuffer
-                    data = data[bdata_remaining:]
-                else:
-                    # Too little data or just enough data to fill block:
-                    # Add all received data to block.
-                    bdata += data
-                    assert len(bdata)<=datalenb, 'Programmer error. Something wrong with data size calculations.'
-                    data = bytes() # empty data input buffer
-
-                if len(bdata) == datalenb:
-                    # Full and complete block received!
-                    # Check the checksum.
-                    incoming_checksum = sum(bdata) & 0xFFFFFFFF
-                    if incoming_checksum == checksum:
-                        # Put block in received blocks queue.
-                        # The block is here just the data preceded with one byte
-                        # indicating the datatype.
-                        # Rest of header is not used anymore.
-                        block = btype + bdata
-                        self.block_q.put(block)
-                    else:
-                        # Data error.
-                        # How should we handle this correctly? 
-                        #TODO
-                        # For now, we print a warning and ignore, we do not
-                        # put any information in the queue. Later, we could
-                        # push a None or some ErrorType? which is then
-                        # picked up in getData.
-                        print('WARNING: Wrong checksum on incoming data.')
-                    instate = 1
+            n = self._recvInto(parser.getBuffer())
+            if not n:
+                break # connection broken or closed
+            blocks = parser.bufferUpdated(n)
+            if metrics is not None:
+                metrics.bytes_in += n
+                metrics.messages_in += len(blocks)
+            seqs = itertools.repeat(None)
+            if parser.tracer is not None:
+                seqs = parser.blockseqs
+            try:
+                for block, seq in zip(blocks, seqs):
+                    self.block_q.put((*block, seq))
+            except queue.Full:
+                break # block_q stopped: Connection closed
 
         
     def _listeningCenterThread(self):
@@ -321,29 +3461,34 @@ class Connection:
         internal communication protocol.
         """
         while not self.stop_sig:
-            # this while loop ensures fastest as possible processing
-            # of incoming blocks
-            while not self.block_q.empty():
+            # blocks are processed as soon as they arrive
+            try:
                 block = self.block_q.get()
-                
-                # decode block
-                btype = block[0:1] # need bytes
-                bdata = block[1:]
-                
-                if btype == FLOATTYPECODE:
-                    data = float.fromhex(bdata.decode('ascii'))
-                elif btype == INTTYPECODE:
-                    data = int.from_bytes(bdata, 
-                                          'little', signed = True)
-                elif btype == STRTYPECODE:
-                    data = bdata.decode('utf-8')
-                elif btype == RAWBYTESTYPECODE:
-                    data = bdata
-                else:
-                    raise TypeError("Received data of unsupported type")
-                
-                self.in_q.put(data)
-            sleep(STIMEOUT)
+            except queue.Empty:
+                break # block_q stopped: Connection closed
+            
+            # decode block (and decompress it)
+            btype, bdata, channel, seq = block
+            try:
+                data = _decodeData(btype, bdata)
+            except (TypeError, ValueError) as err:
+                print('WARNING: {}'.format(err))
+                continue
+            except Exception as err:
+                # an unexpected failure only drops this block
+                print('WARNING: Cannot decode received data ({!r})'.format(
+                      err))
+                continue
+            if seq is not None:
+                data = self._traceDecoded(data, seq)
+            if type(data) is _RPCMessage:
+                self._routeRPC(data)
+                continue
+            
+            try:
+                self._inQueue(channel).put(data)
+            except queue.Full:
+                break # in_q stopped: Connection closed
                     
             
     def _speechCenterThread(self):
@@ -352,89 +3497,180 @@ class Connection:
         implements the internal communication protocol.
         """
         while not self.stop_sig:
-            # In contrast to _listeningCenterThread, which empties the
-            # queue as fast as possbile, blocks are sent separated by 
-            # at least STIMEOUT
-            if not self.out_q.empty():
-                bdata, btype = self.out_q.get()
-                # Following conserved from serpy original and commentized
-                # illustrating handshaking via events
-                #
-                # if mode != self.out_mode :
-                #     self.modeChangeEvent.clear()
-                #     self.out_block_q.put(b"\x01SETMODE" +
-                #                         str(mode).encode(self.encoding))
-                #     self.modeChangeEvent.wait()
-                #     self.out_mode = mode
-                
-                # The only implemented mode in serpy2:
-                # non-blocking/no-handshake                
-                #TODO introduce send with handshake?
-                
-                # encode header
-                checksum = sum(bdata) & 0xFFFFFFFF
-                datacheckb = checksum.to_bytes(4, 'little', signed = False)
-                datalenb = len(bdata).to_bytes(4, 'little', signed = False)
-
-                bhead = BLOCKIDCODE + btype + datacheckb + datalenb
-                assert len(bhead) == HEADLEN, 'HEADLEN incorrect'
-                block = bhead + bdata
-                
-                self.out_block_q.put(block)
+            # blocks are encoded as soon as they are queued by sendData
+            try:
+                bdata, btype, channel, tag = self.out_q.get()
+            except queue.Empty:
+                break # out_q stopped: Connection closed
+            # Following conserved from serpy original and commentized
+            # illustrating handshaking via events
+            #
+            # if mode != self.out_mode :
+            #     self.modeChangeEvent.clear()
+            #     self.out_block_q.put(b"\x01SETMODE" +
+            #                         str(mode).encode(self.encoding))
+            #     self.modeChangeEvent.wait()
+            #     self.out_mode = mode
+            
+            # The only implemented mode in serpy2:
+            # non-blocking/no-handshake                
+            #TODO introduce send with handshake?
+            
+            # encode header(s). The headers and the data are kept apart 
+            # and written with a single vectored write, without 
+            # concatenation. Large data is split into several frames.
+            if btype is None:
+                frames = bdata # encoded already
             else:
-                sleep(STIMEOUT)
+                frames = self._encodeFrames(bdata, btype, channel,
+                                            self._wireSeq(tag))
+            if tag is not None and self.tracer is not None:
+                self.tracer(self, TRACE_ENCODE, tag[0], perf_counter_ns())
+            
+            try:
+                self.out_block_q.put((channel, frames, tag))
+            except queue.Full:
+                break # out_block_q stopped: Connection closed
                 
     
-    def getData(self, timeout=None):
+    def getData(self, timeout=None, channel=0):
         """
         Returns the received data in the original data type
-        Optional argument : timeout (default None)
+        Optional arguments : timeout (default None), channel (default 0:
+        the data received on this channel, see sendData)
         
         Will block until there is data or timeout is reached.
         On timeout will raise queue.Empty exception
         """
-        return self.in_q.get(timeout=timeout)
+        data, seq = self._getItem(timeout, channel)
+        if type(data) is BlockStream:
+            data = data.read()
+        if seq is not None:
+            self.tracer(self, TRACE_GET, seq, perf_counter_ns())
+        return data
+    
+    def _getItem(self, timeout, channel=0):
+        """
+        Get the next item (data or BlockStream) from the in_q of channel.
+        Returns it with the sequence number of its message if it was 
+        traced, None otherwise.
+        """
+        data = self._inQueue(channel).get(timeout=timeout)
+        if self._rx_paused:
+            self.reactor.call(self._resumeReading)
+        if type(data) is _Traced:
+            return data.data, data.seq
+        return data, None
+    
+    def getStream(self, timeout=None, channel=0):
+        """
+        Returns the next raw data received as a BlockStream, a file-like
+        object (read, readinto) whose iteration yields the chunks of the 
+        data as they arrive. Optional arguments : timeout (default None),
+        channel (default 0)
+        
+        Raw data of at least stream_size bytes (see Connection) is returned
+        as soon as it starts arriving, its integrity being verified at the
+        end of the stream. Smaller data is returned as a complete stream.
+        
+        Will block until there is data or timeout is reached.
+        On timeout will raise queue.Empty exception.
+        Raises TypeError if the data received is not raw data.
+        """
+        data, seq = self._getItem(timeout, channel)
+        if seq is not None:
+            self.tracer(self, TRACE_GET, seq, perf_counter_ns())
+        if type(data) is BlockStream:
+            return data
+        if type(data) is bytes or type(data) is memoryview:
+            return BlockStream.fromData(data)
+        raise TypeError("getStream can only receive raw data, not {}".format(
+                        type(data)))
     
-    def sendData(self, data, timeout=None):
+    def getDataInto(self, buffer, timeout=None, channel=0):
+        """
+        Copy the next raw data or ndarray received into the writable 
+        buffer buffer (e.g. a bytearray or a numpy array), and return the
+        number of bytes written. Optional arguments : timeout (default 
+        None), channel (default 0, see getData)
+        
+        The data is not received directly into buffer: it is received as
+        by getData, then copied into buffer (one copy). The receive buffer
+        is then handed back to the pool if it comes from the BufferPool of
+        the Connection: with a pool, no memory is allocated per block 
+        received.
+        
+        Will block until there is data or timeout is reached.
+        On timeout will raise queue.Empty exception.
+        Raises TypeError if the data received is not raw data or an ndarray,
+        and ValueError if it does not fit in buffer (the data is then lost).
+        """
+        data = self.getData(timeout=timeout, channel=channel)
+        try:
+            if type(data) is bytes or type(data) is memoryview or \
+               (np is not None and type(data) is np.ndarray):
+                src = _byteView(data) if len(data) else memoryview(b'')
+            else:
+                raise TypeError("getDataInto can only receive raw data "
+                                "or ndarrays, not {}".format(type(data)))
+            dst = _byteView(buffer)
+            if len(src) > len(dst):
+                raise ValueError("Data received ({} bytes) does not fit in "
+                                 "buffer".format(len(src)))
+            dst[:len(src)] = src
+            return len(src)
+        finally:
+            if self.pool is not None:
+                self.pool.release(data)
+
+    def sendData(self, data, timeout=None, channel=0):
         """
         Send the data over this connection following a mode.
         
         Optional timeout (in seconds [float]) may be specified. 
         May block for a maximum of 2*timeout.
         May raise raise queue.Full exception or return False on timeout
+        
+        The data is sent on the logical channel channel (0 to 255, default
+        0), and received by getData(channel=channel) at the other end. The
+        data of a channel is received in order, but the frames of large
+        data (see chunksize) are interleaved with the data of the other 
+        channels, according to their priorities (see setPriority).
         ------
         
         Currently supports the following types of data
         
         str  : sent as utf-8 encoded bytes
         int  : sent as signed 64-bit integer encoded with int.to_bytes()
+               (compact: as a varint, of any size)
         float: sent as ascii-encoded bytes after representation with float.hex()
+               (compact: as an IEEE-754 binary64)
+        bool, None: sent in 1 byte, 0 byte
+        list, tuple, dict: sent in a compact binary encoding, and may 
+               contain any of the types listed here (see _encodeItem)
         bytes: sent as raw data
-        """
+        numpy.ndarray: sent from the memory of the array, with its dtype
+               and shape. Received as an array over the receive buffer.
+               Structured and object dtypes are not supported (see 
+               _encodeNdarray).
+        numpy scalars (numpy.float64, numpy.int64, numpy.bool_...): sent
+               as the Python object they hold (see numpy.generic.item)
+        EventBatch: sent in columns, timestamps as differences (see
+               _encodeEvents)
+        other objects supporting the buffer protocol (bytearray, memoryview,
+               array.array, mmap, ctypes...), if C-contiguous: sent as raw
+               data, received as bytes.
         
-        # `if type(data) is` vs `isinstance()`...
-        # See: https://switowski.com/blog/type-vs-isinstance
-        # Thanks to Arthur for pointing this out.
-        # Here, we choose the data to be necessarily *exactly* of the unmodified class.
-        # Subclasses not accepted. This behaviour can always be changed later on if required.
-        if type(data) is float:
-            flhex = data.hex()
-            bdata = flhex.encode('ascii')
-            btype = FLOATTYPECODE
-        elif type(data) is int:
-            bdata = data.to_bytes(8, 'little', signed = True)
-            btype = INTTYPECODE
-        elif type(data) is str:
-            bdata = data.encode('utf-8')
-            btype = STRTYPECODE
-        elif type(data) is bytes:
-            bdata = data
-            btype = RAWBYTESTYPECODE
-        else:
-            raise TypeError("Unsupported data type. Cannot Send")
+        Buffers are not copied: the Connection keeps a reference to them
+        until they are written on the socket. A buffer should therefore not
+        be modified before waitSent() returns.
+        """
+        seq = None
+        if self.tracer is not None:
+            seq = self._newSeq()
+        bdata, btype = _encodeData(data, self.compact)
         
-        # --- putting data in queue ---
-        self.out_q.put((bdata, btype), timeout=timeout)
+        self._queueBlock(bdata, btype, timeout, channel, seq)
         
         # The following code was preserved from serpy (and commentized)
         # It demonstrates how to use events to implement handshaking in
@@ -447,6 +3683,221 @@ class Connection:
         
         return
 
+    def sendFile(self, file, offset=0, count=None, timeout=None, channel=0):
+        """
+        Send count bytes (default: up to the end) of the file file from
+        offset, as raw data. file is a path, or a file object opened in
+        binary mode. The file is written on the socket with sendfile,
+        without going through the memory of the process.
+        
+        Optional timeout and channel as for sendData. The file is read 
+        once to compute
+        the checksum (unless the checksum of the Connection is 'none'). A
+        file object must not be used before waitSent() returns.
+        """
+        opened = not hasattr(file, 'fileno')
+        f = open(file, 'rb') if opened else file
+        try:
+            size = os.fstat(f.fileno()).st_size
+            if count is None:
+                count = size - offset
+            if offset < 0 or count < 0 or offset + count > size:
+                raise ValueError("Range out of the file")
+            if opened and not count:
+                f.close()
+            self._queueBlock(_FileRange(f, offset, count, opened),
+                             RAWBYTESTYPECODE, timeout, channel)
+        except Exception:
+            if opened:
+                f.close()
+            raise
+
+    def getFile(self, file, timeout=None, use_mmap=False):
+        """
+        Receive the next raw data into the file file (a path, or a file
+        object opened in binary mode for writing, the data being written
+        at its current position), and return the number of bytes received.
+        Optional arguments : timeout (default None), use_mmap (default 
+        False)
+        
+        The file is first extended to the size of the data. The data is
+        then written into it chunk by chunk as it arrives (see getStream 
+        and the stream_size argument of Connection), through a memory map
+        of the file if use_mmap is True (the file object must then also 
+        be readable). The memory used does not depend on the size of the
+        data.
+        
+        Will block until there is data or timeout is reached.
+        On timeout will raise queue.Empty exception.
+        Raises TypeError if the data received is not raw data, IOError if
+        it is corrupted (the file is then left with the data received).
+        """
+        stream = self.getStream(timeout)
+        opened = not hasattr(file, 'write')
+        f = open(file, 'w+b' if use_mmap else 'wb') if opened else file
+        try:
+            pos = f.tell()
+            f.truncate(pos + stream.size)
+            n = 0
+            if use_mmap and stream.size:
+                f.flush()
+                with mmap.mmap(f.fileno(), pos + stream.size) as mm:
+                    view = memoryview(mm)
+                    while n < stream.size:
+                        k = stream.readinto(view[pos+n:])
+                        if not k:
+                            break
+                        n += k
+                    view.release()
+                f.seek(pos + n)
+            else:
+                for chunk in stream:
+                    f.write(chunk)
+                    n += len(chunk)
+            stream.read() # verifies the integrity of the data
+            return n
+        finally:
+            stream.close()
+            if opened:
+                f.close()
+
+    def _newSeq(self):
+        """A new message sequence number, traced as sent (see tracer)."""
+        seq = next(_MESSAGESEQ)
+        if self.tracer is not None:
+            self.tracer(self, TRACE_SEND, seq, perf_counter_ns())
+        return seq
+
+    def _wireSeq(self, tag):
+        """The sequence number sent with a message, only if traced."""
+        if tag is not None and self.tracer is not None:
+            return tag[0]
+        return None
+
+    def _queueBlock(self, bdata, btype, timeout, channel=0, seq=None):
+        """
+        Queue the encoded data for sending (see sendData). If btype is 
+        None, bdata is the list of frames of a message encoded already
+        (see Server.broadcast). seq is the sequence number of the message,
+        if sendData numbered it already.
+        """
+        if not 0 <= channel < NBCHANNELS:
+            raise ValueError("channel must be in 0..{}".format(NBCHANNELS-1))
+        with self._sentCond:
+            self._nqueued += 1
+        tag = None
+        if self.metrics is not None or self.tracer is not None:
+            if seq is None:
+                seq = self._newSeq()
+            tag = (seq, perf_counter_ns())
+        try:
+            self._putBlock(bdata, btype, timeout, channel, tag)
+        except queue.Full:
+            with self._sentCond:
+                self._nqueued -= 1
+            raise
+
+    def _putBlock(self, bdata, btype, timeout, channel=0, tag=None):
+        """Put the encoded data into the out_q, with its tag."""
+        if self.engine == 'selector':
+            # The whole block is encoded here, in the calling thread, and
+            # queued for the Reactor, which writes it out.
+            frames = bdata if btype is None else \
+                     self._encodeFrames(bdata, btype, channel,
+                                        self._wireSeq(tag))
+            if tag is not None and self.tracer is not None:
+                self.tracer(self, TRACE_ENCODE, tag[0], perf_counter_ns())
+            self._putOut((channel, frames, tag), timeout)
+            # The Reactor clears _writing before it checks the out_q a
+            # last time, so that a block queued here is never forgotten.
+            if not self._writing:
+                self._writing = True
+                if self.reactor is not None:
+                    self.reactor.call(self._wantWrite)
+            return
+        
+        # --- putting data in queue ---
+        self._putOut((bdata, btype, channel, tag), timeout)
+
+    def _putOut(self, item, timeout):
+        """Put item into the out_q, timing the wait if metrics are on."""
+        if self.metrics is None:
+            self.out_q.put(item, timeout=timeout)
+            return
+        start = perf_counter_ns()
+        try:
+            self.out_q.put(item, timeout=timeout)
+        finally:
+            stall = perf_counter_ns() - start
+            with self._sentCond:
+                self.metrics.send_stall += stall
+
+    def _encodeFrames(self, bdata, btype, channel=0, seq=None):
+        """
+        The frames to send for the encoded data on channel, compressed 
+        according to the compress options, carrying the sequence number 
+        seq if not None (see FRAME_SEQ).
+        """
+        flags = 0
+        if self.compress is not None and btype in self.compress_types and \
+           type(bdata) is not _FileRange:
+            bdata, flags = _compressData(bdata, self.compress,
+                                         self.compress_min)
+        return _encodeFrames(bdata, btype, self.checksum, self.chunksize,
+                             flags, channel, seq)
+
+    def _blockSent(self, count=1):
+        """Called by the writing thread each time blocks are written."""
+        with self._sentCond:
+            self._nsent += count
+            if self._nsent >= self._nqueued:
+                self._sentCond.notify_all()
+
+    def _framesTaken(self, views, done, tag, tags):
+        """
+        The buffers views of a frame of the message of tag are handed to 
+        the socket (metrics or tracer on). If done, the frame is the last
+        of the message, whose tag is added to tags.
+        """
+        metrics = self.metrics
+        if metrics is not None:
+            size = sum(len(v) for v in views)
+            metrics.bytes_out += size
+            metrics.frames_out += 1
+            metrics.frame_size.observe(size)
+        if self.tracer is not None:
+            self.tracer(self, TRACE_HANDOFF, tag[0], perf_counter_ns())
+        if done:
+            tags.append(tag)
+
+    def _tagsSent(self, tags):
+        """
+        The messages of tags have been written out (metrics or tracer on).
+        """
+        now = perf_counter_ns()
+        metrics, tracer = self.metrics, self.tracer
+        for seq, queued in tags:
+            if metrics is not None:
+                metrics.send_latency.observe((now - queued) * 1e-9)
+            if tracer is not None:
+                tracer(self, TRACE_WRITTEN, seq, now)
+
+    def waitSent(self, timeout=None):
+        """
+        Wait until all the data passed to sendData so far has been written
+        on the socket, after which the buffers sent may safely be modified
+        or reused.
+        
+        Optional timeout (in seconds [float]) may be specified.
+        Returns True if all the data was written, False on timeout or if
+        the connection was closed in the mean time.
+        """
+        with self._sentCond:
+            target = self._nqueued
+            self._sentCond.wait_for(lambda: self._nsent >= target 
+                                            or self.stop_sig, timeout)
+            return self._nsent >= target
+
     def enableRestart(self):
         """Enable auto restart when the connection is broken"""
         self.auto_restart = True
@@ -459,13 +3910,431 @@ class Connection:
         """Returns True if connected."""
         return self.connected
     
-    def isDataAvailable(self):
+    def setPriority(self, channel, priority):
+        """
+        Set the priority of the logical channel channel (default 0 for
+        all channels). The frames of the data sent on the channels of 
+        higher priority are written first.
+        """
+        self.priorities[channel] = priority
+
+    def isDataAvailable(self, channel=0):
         """
         Return True if there is new data available 
-        (ie: in the input queue)
+        (ie: in the input queue of the channel)
+        """
+        return not self._inQueue(channel).empty()
+
+    def stats(self):
+        """
+        Returns a snapshot of the statistics of this Connection, as a dict
+        (see STATS). Histograms are dicts of their bounds, counts, sum 
+        and count (see Histogram). The statistics of METRICSONLY are only
+        included with metrics=True.
+        """
+        parser = self._parser
+        in_qs = [self.in_q, self.block_q, *list(self.channel_qs.values())]
+        out_qs = (self.out_q, self.out_block_q)
+        stats = {
+            'frames_in': parser.frames if parser else 0,
+            'messages_queued': self._nqueued,
+            'messages_sent': self._nsent,
+            'checksum_errors': parser.checksum_errors if parser else 0,
+            'resyncs': parser.resyncs if parser else 0,
+            'reconnects': self.reconnects,
+            'in_dropped': sum(q.dropped for q in in_qs),
+            'out_dropped': sum(q.dropped for q in out_qs),
+            'in_queued': sum(q.qsize() for q in in_qs),
+            'out_queued': sum(q.qsize() for q in out_qs),
+            'in_budget_used': self.in_budget.used if self.in_budget else 0,
+            'out_budget_used': self.out_budget.used if self.out_budget else 0,
+        }
+        if self.metrics is not None:
+            stats.update(self.metrics.snapshot())
+        return stats
+
+
+
+
+class EventBatcher:
+    """
+    Accumulates events (timestamp and optional channel id) and sends them
+    over the Connection connection as EventBatch objects. A batch is sent
+    as soon as it holds at least max_events events, or max_delay seconds after its
+    first event was added (if max_delay is not None), whichever comes 
+    first.
+    
+    For high event rates, add the events in arrays with extend rather than
+    one by one with add. All the events of a batcher either have a channel
+    id or none has.
+    
+    The batches due after max_delay are sent by a single thread, started
+    with the first event and stopped by close. An exception raised while
+    it sends a batch (which is then lost) is raised by the next call to 
+    add, extend, flush or close.
+    
+    Usage:
+        >>> b = EventBatcher(c, max_events=65536, max_delay=0.01)
+        >>> b.extend(times, channels)   # e.g. NumPy arrays read from the
+        >>> b.add(t, ch)                #      instrument, or one event
+        >>> b.close()                   # sends the last events
+    """
+    def __init__(self, connection, max_events=65536, max_delay=0.01):
+        if max_events < 1:
+            raise ValueError("max_events must be at least 1")
+        self.connection = connection
+        self.max_events = max_events
+        self.max_delay = max_delay
+        self.lock = threading.Lock()
+        self._cond = threading.Condition(self.lock)
+        self._times = []    # accumulated chunks (lists or arrays)
+        self._channels = []
+        self._count = 0
+        self._haschannels = None
+        self._thread = None   # sending the batches due after max_delay
+        self._deadline = None # monotonic() time the batch is due
+        self._error = None    # raised by the thread, for the caller
+        self.batches = 0      # number of batches sent
+
+    def add(self, time, channel=None):
+        """Add one event."""
+        with self.lock:
+            self._raiseError()
+            self._checkChannels(channel is not None)
+            if not self._times or type(self._times[-1]) is not list:
+                self._times.append([])
+                self._channels.append([])
+            self._times[-1].append(time)
+            if channel is not None:
+                self._channels[-1].append(channel)
+            self._count += 1
+            self._added()
+
+    def extend(self, times, channels=None):
+        """
+        Add the events with timestamps times (sorted) and channel ids
+        channels (sequences or arrays of the same length).
+        """
+        if channels is not None and len(channels) != len(times):
+            raise ValueError("There must be one channel id per event")
+        if not len(times):
+            return
+        with self.lock:
+            self._raiseError()
+            self._checkChannels(channels is not None)
+            self._times.append(times)
+            self._channels.append(channels)
+            self._count += len(times)
+            self._added()
+
+    def flush(self):
+        """Send the events accumulated so far."""
+        with self.lock:
+            self._raiseError()
+            self._flush()
+
+    def close(self):
+        """Send the events accumulated so far and stop the thread."""
+        with self.lock:
+            thread, self._thread = self._thread, None
+            self._cond.notify()
+        if thread is not None:
+            thread.join()
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _checkChannels(self, haschannels):
+        if self._haschannels is None:
+            self._haschannels = haschannels
+        elif haschannels != self._haschannels:
+            raise ValueError("Either all events have a channel id or none")
+
+    def _raiseError(self):
+        if self._error is not None:
+            err, self._error = self._error, None
+            raise err
+
+    def _added(self):
+        if self._count >= self.max_events:
+            self._flush()
+        elif self._deadline is None and self.max_delay is not None:
+            self._deadline = monotonic() + self.max_delay
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._delayThread,
+                                                daemon=True)
+                self._thread.start()
+            self._cond.notify()
+
+    def _delayThread(self):
+        """Send the batches due after max_delay, until close."""
+        with self.lock:
+            while self._thread is threading.current_thread():
+                if self._deadline is None:
+                    self._cond.wait()
+                    continue
+                delay = self._deadline - monotonic()
+                if delay > 0:
+                    self._cond.wait(delay)
+                    continue
+                try:
+                    self._flush()
+                except Exception as err:
+                    self._error = err
+
+    def _flush(self):
+        self._deadline = None
+        if not self._count:
+            return
+        if np is not None:
+            times = np.concatenate([np.asarray(t, np.int64) 
+                                    for t in self._times])
+            channels = np.concatenate([np.asarray(c) for c in 
+                                       self._channels]) \
+                       if self._haschannels else None
+        else:
+            times = [t for chunk in self._times for t in chunk]
+            channels = [c for chunk in self._channels for c in chunk] \
+                       if self._haschannels else None
+        self._times, self._channels, self._count = [], [], 0
+        self.connection.sendData(EventBatch(times, channels))
+        self.batches += 1
+
+
+
+
+class RPCClient:
+    """
+    Calls the methods served by the RPCDispatcher at the other end of the
+    Connection connection (request/response). Each request carries an id,
+    repeated in its reply, so that many requests can be in flight at once
+    (pipelining) and that a reply lost or arriving late does not mix up
+    the others.
+    
+    call returns a concurrent.futures.Future, which gets the result of the
+    call, RPCError if the remote handler failed, TimeoutError if no reply
+    came within the timeout (default: the timeout of the RPCClient, None:
+    no limit), or ConnectionError if the connection was closed or broken.
+    The callbacks of the futures run in the receiving thread of the 
+    Connection, and should not block.
+    
+    The arguments and the results may be of any of the types that can be
+    sent in a list (see sendData).
+    
+    Usage:
+        >>> rpc = RPCClient(c, timeout=5.0)
+        >>> futures = [rpc.call('setExposure', (t,)) for t in times]
+        >>> img = rpc.call('acquire').result()
+    """
+    def __init__(self, connection, timeout=None):
+        self.connection = connection
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self._cond = threading.Condition(self.lock)
+        self._pending = {}   # request id: Future
+        self._deadlines = [] # heap of (deadline, request id)
+        self._ids = itertools.count()
+        self._expirer = None
+        self._closed = False
+        connection.rpc_client = self
+
+    def call(self, method, args=(), timeout=None):
+        """
+        Call the method method (str) with the arguments args (tuple) on
+        the remote RPCDispatcher. Returns a Future.
+        """
+        if timeout is None:
+            timeout = self.timeout
+        f = Future()
+        f.set_running_or_notify_cancel()
+        with self.lock:
+            if self._closed:
+                raise ConnectionError("RPCClient closed")
+            rid = next(self._ids)
+            self._pending[rid] = f
+            if timeout is not None:
+                heapq.heappush(self._deadlines, (monotonic() + timeout, rid))
+                if self._expirer is None:
+                    self._expirer = threading.Thread(target=self._expire,
+                                                     daemon=True)
+                    self._expirer.start()
+                self._cond.notify()
+        try:
+            self.connection.sendData(_RPCMessage(RPC_REQUEST, rid, method,
+                                                 args))
+        except BaseException:
+            with self.lock:
+                self._pending.pop(rid, None)
+            raise
+        return f
+
+    def close(self):
+        """
+        Detach from the Connection. The calls waiting for a reply fail
+        with ConnectionError.
+        """
+        with self.lock:
+            self._closed = True
+            self._cond.notify()
+        if self.connection.rpc_client is self:
+            self.connection.rpc_client = None
+        self._connectionLost()
+
+    def _onMessage(self, connection, msg):
+        """Complete the Future of the request msg replies to."""
+        with self.lock:
+            f = self._pending.pop(msg.rid, None)
+        if f is None:
+            return # reply arriving after the timeout
+        if msg.kind == RPC_REPLY:
+            f.set_result(msg.value)
+        else:
+            f.set_exception(RPCError(msg.value))
+
+    def _connectionLost(self):
+        """Fail the calls waiting for a reply."""
+        with self.lock:
+            pending, self._pending = self._pending, {}
+            self._deadlines = []
+        for f in pending.values():
+            f.set_exception(ConnectionError("Connection closed"))
+
+    def _expire(self):
+        """Thread failing the calls that did not get a reply in time."""
+        with self.lock:
+            while not self._closed:
+                now = monotonic()
+                expired = []
+                while self._deadlines and self._deadlines[0][0] <= now:
+                    f = self._pending.pop(heapq.heappop(self._deadlines)[1],
+                                          None)
+                    if f is not None:
+                        expired.append(f)
+                if expired:
+                    self.lock.release()
+                    try:
+                        for f in expired:
+                            f.set_exception(TimeoutError(
+                                "No reply to the RPC call"))
+                    finally:
+                        self.lock.acquire()
+                    continue
+                self._cond.wait(self._deadlines[0][0] - now 
+                                if self._deadlines else None)
+            self._expirer = None
+
+
+
+
+class RPCDispatcher:
+    """
+    Serves RPC requests (see RPCClient): runs the handler registered for 
+    the method called, on a pool of max_workers threads (default: see
+    concurrent.futures.ThreadPoolExecutor), and sends its result back. The
+    requests are handled concurrently, so the replies may be sent in 
+    another order than the requests were received. Exceptions raised by
+    the handlers are sent back as RPCError.
+    
+    The dispatcher is attached to a Connection, or to a Server, for all
+    of its child Connections.
+    
+    Usage:
+        >>> d = RPCDispatcher({'acquire': acquire})
+        >>> @d.register('setExposure')
+        ... def setExposure(t):
+        ...     ...
+        >>> s = Server(adr, port, nb_conn).start()
+        >>> d.attach(s)
+        >>> ...
+        >>> d.close()
+    """
+    def __init__(self, handlers=None, max_workers=None):
+        self.handlers = dict(handlers or {})
+        self.executor = ThreadPoolExecutor(max_workers, 
+                                           thread_name_prefix='serpy2-rpc')
+
+    def register(self, name, func=None):
+        """
+        Register func as the handler of the method name. Without func,
+        returns a decorator.
+        """
+        if func is None:
+            return lambda func: self.register(name, func)
+        self.handlers[name] = func
+        return func
+
+    def attach(self, target):
+        """
+        Serve the requests received by the Connection or Server target.
+        Returns target.
         """
-        return not self.in_q.empty()
+        target.rpc_dispatcher = self
+        if type(target) is Server:
+            for c in target.getConnectionsList():
+                c.rpc_dispatcher = self
+        return target
+
+    def close(self):
+        """Stop the threads, once the requests received are handled."""
+        self.executor.shutdown(wait=False)
+
+    def _onMessage(self, connection, msg):
+        try:
+            self.executor.submit(self._handle, connection, msg)
+        except RuntimeError:
+            pass # dispatcher closed
+
+    def _handle(self, connection, msg):
+        """Run the handler of the request msg and send its reply."""
+        try:
+            handler = self.handlers[msg.method]
+        except (KeyError, TypeError):
+            reply = _RPCMessage(RPC_ERROR, msg.rid, None, 
+                                "Unknown method {!r}".format(msg.method))
+        else:
+            try:
+                reply = _RPCMessage(RPC_REPLY, msg.rid, None,
+                                    handler(*msg.value))
+            except Exception as err:
+                reply = _RPCMessage(RPC_ERROR, msg.rid, None, 
+                                    '{}: {}'.format(type(err).__name__, err))
+        try:
+            try:
+                connection.sendData(reply)
+            except TypeError as err: # result of an unsupported type
+                connection.sendData(_RPCMessage(RPC_ERROR, msg.rid, None,
+                                                str(err)))
+        except (ConnectionError, OSError, queue.Full):
+            pass # the caller will get ConnectionError or TimeoutError
+
+
+
+
+class _Acceptor:
+    """
+    Accepts new connections on the listening socket of a Server from
+    within a Reactor thread (Server with engine='selector').
+    """
+    def __init__(self, server):
+        self.server = server
+        self.conn = server.serv
+        self.stop_sig = False
+
+    def _selectorEvents(self):
+        return selectors.EVENT_READ
+
+    def _onReadable(self):
+        self.server._accept()
+
+    def _onWritable(self):
+        pass
 
+    def _onBroken(self):
+        pass # the listening socket stays open
 
 
 
@@ -480,14 +4349,68 @@ class Server:
     The server can accept at most nb_conn (default 5) concurent 
     connections.
     
+    With engine='selector', no thread is created per connection: a fixed
+    pool of nb_reactors Reactor threads (default 1) accepts the new
+    connections and serves the sockets of all child Connections. The
+    number of threads then does not grow with the number of clients.
+    
     Usage :
      - To create a server:
         >>> s = Server(adr, port, nb_conn).start()
+     - To create a server for many clients:
+        >>> s = Server(adr, port, 1000, engine='selector').start()
+    
+    The checksum, nodelay, cork, coalesce_bytes, coalesce_delay, compress,
+    compress_min, compress_types, compact, in_policy, out_policy, in_bytes,
+    out_bytes and max_message arguments are those of the child 
+    Connections (see Connection). memory_budget (in bytes) limits the memory held by the
+    queues of all the child Connections together.
+    
+    stats() returns the statistics of all the child Connections together
+    (instrumented if metrics is True, see Connection), including those 
+    of the Connections gone. The optional tracer is that of all the child
+    Connections (see Connection).
     """
-    def __init__(self, adr, port, nb_conn=5):
+    def __init__(self, adr, port, nb_conn=5, engine='threads',
+                 nb_reactors=1, checksum='sum', nodelay=None, cork=False,
+                 coalesce_bytes=0, coalesce_delay=0.0, compress=None,
+                 compress_min=COMPRESSMIN, compress_types=COMPRESSTYPES,
+                 compact=False, in_policy='block', out_policy='block',
+                 in_bytes=None, out_bytes=None, memory_budget=None,
+                 metrics=False, tracer=None, max_message=MAXMESSAGE):
+        if engine not in ENGINES:
+            raise ValueError("Unknown engine '{}'".format(engine))
+        _checkChecksumName(checksum)
+        _checkCodecName(compress)
+        _checkQueuePolicy(in_policy)
+        _checkQueuePolicy(out_policy)
+        self.compress = compress
+        self.compress_min = compress_min
+        self.compress_types = compress_types
+        self.compact = compact
+        self.in_policy = in_policy
+        self.out_policy = out_policy
+        self.in_bytes = in_bytes
+        self.out_bytes = out_bytes
+        self.budget = ByteBudget(memory_budget) if memory_budget else None
+        self.rpc_dispatcher = None # RPCDispatcher of the child Connections
+        self.broadcast_drops = 0 # Connections skipped by broadcast
+        self.metrics = metrics
+        self.tracer = tracer
+        self.max_message = max_message
+        self._retired = {} # counters of the child Connections gone
+        self.checksum = checksum
+        self.nodelay = nodelay
+        self.cork = cork
+        self.coalesce_bytes = coalesce_bytes
+        self.coalesce_delay = coalesce_delay
         self.adr = adr
         self.port = port
         self.nb_conn = nb_conn
+        self.engine = engine
+        self.nb_reactors = nb_reactors
+        self.reactors = []
+        self._next_reactor = 0
         self.lock = threading.Lock()
         self.serv = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.serv.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
@@ -498,9 +4421,17 @@ class Server:
 
     def _serverThread(self):
         while not self.stop_sig:
-            readable, writable, errored = select.select((self.serv,),
-                                                        [], [], STIMEOUT)
+            # Blocks until a client connects, or until close() wakes it up
+            readable, writable, errored = select.select((self.serv,
+                                                         self._wake_r),
+                                                        [], [])
+            if self.stop_sig:
+                break
             for s in readable :
+                if s is self._wake_r:
+                    continue
+                with self.lock:
+                    self._prune() # clear the closed connections
                 #TODO: handle the following as a proper Exception
                 # or have a better way of reacting to too many requests.
                 # At present, the server just completely gives up.
@@ -508,12 +4439,73 @@ class Server:
                     "Too many connections on this Server! Aborting..."
                 conn, adr = s.accept()
                 #warnings.warn("Connection to ", adr, " accepted")
-                c = Connection(sock=conn)
+                c = self._newConnection(conn)
                 c.start()
-                self.connections.append(c)
-            for c in self.connections: #clear disconected connections
-                if not c.connected:
-                    self.connections.remove(c)
+                with self.lock:
+                    self._prune()
+                    self.connections.append(c)
+
+    def _newConnection(self, sock, **kwargs):
+        """Make a child Connection for the accepted socket sock."""
+        c = Connection(sock=sock, checksum=self.checksum, 
+                       nodelay=self.nodelay, cork=self.cork,
+                       coalesce_bytes=self.coalesce_bytes,
+                       coalesce_delay=self.coalesce_delay,
+                       compress=self.compress, compress_min=self.compress_min,
+                       compress_types=self.compress_types,
+                       compact=self.compact, in_policy=self.in_policy,
+                       out_policy=self.out_policy, in_bytes=self.in_bytes,
+                       out_bytes=self.out_bytes, budget=self.budget,
+                       metrics=self.metrics, tracer=self.tracer,
+                       max_message=self.max_message, **kwargs)
+        c._server = self
+        c.rpc_dispatcher = self.rpc_dispatcher
+        return c
+
+    def _forget(self, c):
+        """Clear a broken child Connection from the connections list."""
+        with self.lock:
+            self._prune(c)
+        c._clearOutput() # will never be sent: give back its memory budget
+
+    def _prune(self, gone=None):
+        """
+        Clear gone and the closed Connections from the connections list, 
+        keeping their counters for stats. Called with the lock held.
+        """
+        connections = []
+        for c in self.connections:
+            if c is not gone and c.connected:
+                connections.append(c)
+            else:
+                _addStats(self._retired, c.stats(), gauges=False)
+        self.connections = connections
+
+    def _accept(self):
+        """
+        Accept a new connection (engine='selector'). Runs in the Reactor
+        thread, so it must never block.
+        """
+        try:
+            conn, adr = self.serv.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            return # listening socket closed
+        with self.lock:
+            self._prune()
+            if len(self.connections) >= self.nb_conn:
+                # refuse the connection instead of giving up completely
+                warnings.warn("Too many connections on this Server! "
+                              "Refusing connection from {}".format(adr))
+                conn.close()
+                return
+            # spread the connections over the reactor pool
+            r = self.reactors[self._next_reactor]
+            self._next_reactor = (self._next_reactor + 1) % len(self.reactors)
+            c = self._newConnection(conn, engine='selector', reactor=r)
+            c.start()
+            self.connections.append(c)
     
     def __iter__(self):
         """
@@ -532,6 +4524,14 @@ class Server:
         """
         Start the server thread. Returns self (ie: the Server object)
         """
+        if self.engine == 'selector':
+            self.reactors = [Reactor().start()
+                             for i in range(max(1, self.nb_reactors))]
+            self.serv.setblocking(False)
+            self._acceptor = _Acceptor(self)
+            self.reactors[0].register(self._acceptor)
+            return self
+        self._wake_r, self._wake_w = socket.socketpair()
         self.tSer = threading.Thread(target=self._serverThread)
         self.tSer.start()
         return self
@@ -542,9 +4542,17 @@ class Server:
         One can still get the connection list afterward.
         """
         self.stop_sig = True
-        self.tSer.join()
+        if self.engine == 'selector':
+            self.reactors[0].unregister(self._acceptor)
+        else:
+            self._wake_w.send(b'\x00')
+            self.tSer.join()
+            self._wake_r.close()
+            self._wake_w.close()
         for c in self.connections :
             c.close()
+        for r in self.reactors:
+            r.close()
         self.serv.close()
 
     def getConnectionsList(self):
@@ -569,6 +4577,162 @@ class Server:
         """
         return [c for c in self.connections if c.isDataAvailable()]
 
+    def broadcast(self, data, exclude=(), policy='block', timeout=None,
+                  channel=0):
+        """
+        Send data to all the child Connections, except those in exclude (a
+        Connection, or a collection of Connections). The data is encoded,
+        checksummed (and compressed) once: the same frames are queued on 
+        every Connection.
+        
+        policy sets what happens to the Connections whose output queue is
+        full (slow clients):
+         - 'block': wait for room (at most timeout seconds, if not None,
+           after which the data is not sent to this Connection)
+         - 'drop': the data is not sent to this Connection
+         - 'disconnect': the Connection is closed
+        The Connections skipped are counted in broadcast_drops.
+        
+        Returns the number of Connections the data was queued on.
+        """
+        if policy not in BROADCAST_POLICIES:
+            raise ValueError("Unknown broadcast policy '{}'".format(policy))
+        if type(exclude) is Connection:
+            exclude = (exclude,)
+        conns = [c for c in self.getConnectionsList() 
+                 if c.connected and c not in exclude]
+        if not conns:
+            return 0
+        bdata, btype = _encodeData(data, self.compact)
+        # a traced message has the same sequence number on every 
+        # Connection, since the frames carry it
+        seq = None
+        if self.tracer is not None:
+            seq = next(_MESSAGESEQ)
+            t = perf_counter_ns()
+            for c in conns:
+                self.tracer(c, TRACE_SEND, seq, t)
+        # all the child Connections share the encoding options of the 
+        # Server, so any of them can encode the frames
+        frames = conns[0]._encodeFrames(bdata, btype, channel, seq)
+        if policy != 'block':
+            timeout = 0
+        sent = 0
+        for c in conns:
+            try:
+                c._queueBlock(frames, None, timeout, channel, seq)
+            except queue.Full:
+                self.broadcast_drops += 1
+                if policy == 'disconnect':
+                    c.close()
+                    self._forget(c)
+            else:
+                sent += 1
+        return sent
+
+    def stats(self):
+        """
+        Returns a snapshot of the statistics of the server, as a dict (see
+        STATS and Connection.stats): the counters of all the child 
+        Connections (gone ones included) and the gauges of the active ones
+        added up.
+        """
+        conns = self.getConnectionsList()
+        with self.lock:
+            stats = _addStats({}, self._retired)
+        for c in conns:
+            _addStats(stats, c.stats())
+        stats['connections'] = sum(1 for c in conns if c.connected)
+        stats['broadcast_drops'] = self.broadcast_drops
+        stats['budget_used'] = self.budget.used if self.budget else 0
+        return stats
+
+
+
+class MetricsExporter:
+    """
+    Serves the statistics of a Connection or a Server (or of any object
+    with a stats method returning a dict as Connection.stats) in the 
+    Prometheus text format, at http://adr:port/metrics, from a thread of
+    its own. Only the standard library is used. The metrics are named 
+    after STATS, with the prefix prefix (default 'serpy2').
+    
+    Usage :
+        >>> s = Server(adr, port, metrics=True).start()
+        >>> e = MetricsExporter(s, 9464).start()
+        >>> e.close()
+    """
+    def __init__(self, source, port=9464, adr='127.0.0.1', prefix='serpy2'):
+        self.source = source
+        self.adr = adr
+        self.port = port
+        self.prefix = prefix
+        self.httpd = None
+        self.thread = None
+
+    def start(self):
+        """Start serving. Returns self (ie: the MetricsExporter object)"""
+        exporter = self
+        
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = exporter.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 
+                                 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass # no logging of every scrape on stderr
+        
+        self.httpd = http.server.ThreadingHTTPServer((self.adr, self.port),
+                                                     Handler)
+        self.port = self.httpd.server_address[1] # if port was 0
+        self.thread = threading.Thread(target=self.httpd.serve_forever,
+                                       daemon=True)
+        self.thread.start()
+        return self
+
+    def close(self):
+        """Stop serving and close the listening socket."""
+        if self.httpd is not None:
+            self.httpd.shutdown()
+            self.httpd.server_close()
+            self.thread.join()
+            self.httpd = None
+
+    def render(self):
+        """The statistics of the source in the Prometheus text format."""
+        stats = self.source.stats()
+        lines = []
+        for name, kind, doc in STATS:
+            if name not in stats:
+                continue
+            metric = '{}_{}'.format(self.prefix, name)
+            if kind == 'counter':
+                metric += '_total'
+            lines.append('# HELP {} {}'.format(metric, doc))
+            lines.append('# TYPE {} {}'.format(metric, kind))
+            value = stats[name]
+            if kind != 'histogram':
+                lines.append('{} {}'.format(metric, value))
+                continue
+            n = 0
+            for bound, count in zip(value['bounds'], value['counts']):
+                n += count
+                lines.append('{}_bucket{{le="{}"}} {}'.format(metric, 
+                                                              bound, n))
+            lines.append('{}_bucket{{le="+Inf"}} {}'.format(metric, 
+                                                            value['count']))
+            lines.append('{}_sum {}'.format(metric, value['sum']))
+            lines.append('{}_count {}'.format(metric, value['count']))
+        return '\n'.join(lines) + '\n'
+
 def main(args):
     return 0
 